@@ -0,0 +1,257 @@
+"""Camera capture that runs on its own thread.
+
+cv2.VideoCapture.read() blocks until the driver hands over a frame, and the
+driver queues frames while we are busy processing the previous one. So when
+the processing loop runs slower than the camera, we end up reacting to lights
+that are already several frames old.
+
+The FrameGrabber() reads frames on a background thread into a LatestFrame
+buffer that holds only one (the newest) frame. Older frames that were never
+consumed are dropped and counted. The processing loop always gets the most
+recent frame, and the glass-to-MIDI latency stays bounded by a single frame
+plus the processing time.
+
+The camera mode (resolution, fps and pixel format) can be negotiated via
+the CAP_PROP_* properties. Most USB cameras support two pixel formats:
+ - 'YUYV' - uncompressed, the Y (luma) is every other byte
+ - 'MJPG' - JPEG-compressed frames (higher resolutions/fps over USB 2.0)
+
+In the 'raw' mode, the frames are not converted to BGR by OpenCV.
+The detector needs only the brightness, so it takes the luma plane directly
+(see luma()), and the full color conversion is done only when the frame is
+actually shown (see bgr()). That saves a lot of memory traffic per frame.
+
+cv2.VideoCapture is not thread-safe, so while the grabber thread runs, only
+it touches the camera: set() only queues the property changes for it, and
+get() returns the property values it reads after every frame.
+
+Usage:
+>>> with FrameGrabber(0, width=1920, height=1080, pixel_format='MJPG', raw=True) as cap:
+>>>     while cap.is_open():
+>>>         frame, timestamp = cap.read()
+>>>         gray = cap.luma(frame)
+>>>         ...
+"""
+
+import queue
+import threading
+import time
+
+import numpy as np
+import cv2
+
+__all__ = ['FrameGrabber', 'LatestFrame']
+
+
+class LatestFrame:
+    """A bounded (single slot) buffer that keeps only the newest frame.
+
+    The producer put()s frames at its own pace, and the consumer take()s them.
+    If the producer puts a new frame before the old one was taken,
+    the old frame is dropped (and counted in the 'dropped' counter).
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._frame = None
+        self._timestamp = 0.0
+        self._is_fresh = False
+        self._closed = False
+
+        self.produced = 0
+        self.consumed = 0
+        self.dropped = 0
+        # The age (in seconds) of the last taken frame, i.e. the time that the
+        # frame spent in the buffer before the consumer picked it up.
+        self.last_age = 0.0
+        self.max_age = 0.0
+
+    def put(self, frame, timestamp):
+        with self._cond:
+            if self._is_fresh:
+                self.dropped += 1
+            self._frame = frame
+            self._timestamp = timestamp
+            self._is_fresh = True
+            self.produced += 1
+            self._cond.notify()
+
+    def take(self, timeout=None):
+        """Wait for a frame that wasn't taken yet and return it.
+
+        Returns a (frame, timestamp) tuple, or (None, None) when the buffer is
+        closed or the timeout expired.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._is_fresh or self._closed, timeout)
+            if not self._is_fresh:
+                return None, None
+            self._is_fresh = False
+            self.consumed += 1
+            self.last_age = time.time() - self._timestamp
+            self.max_age = max(self.max_age, self.last_age)
+            return self._frame, self._timestamp
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class FrameGrabber:
+    """A cv2.VideoCapture wrapper that reads frames on a background thread.
+
+    The read() method returns the newest captured frame and its capture
+    timestamp (in the time.time() scale). Counters are available as attributes
+    of the 'buffer' (see LatestFrame) and summarized by stats().
+
+    The width/height/fps/pixel_format are requested from the camera, but the
+    camera may choose the closest mode it supports, so check the actual ones
+    (the attributes of the same name) after the construction.
+    """
+
+    def __init__(self, camera_id=0, width=None, height=None, fps=None,
+                 pixel_format=None, raw=False):
+        self.cap = cv2.VideoCapture(camera_id)
+        self.buffer = LatestFrame()
+        self._thread = None
+        self._running = False
+        self._controls = queue.Queue()  # (prop_id, value) to set on the thread
+        self._props_cond = threading.Condition()
+        self._props = {}  # prop_id -> the value read on the thread (or None)
+        self.configure(width, height, fps, pixel_format, raw)
+
+    def configure(self, width=None, height=None, fps=None, pixel_format=None, raw=False):
+        # The pixel format should be set first, because it limits the
+        # resolutions/fps that the camera supports.
+        if pixel_format is not None:
+            self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*pixel_format))
+        if width is not None:
+            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        if height is not None:
+            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        if fps is not None:
+            self.cap.set(cv2.CAP_PROP_FPS, fps)
+
+        self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS)
+        fourcc = int(self.cap.get(cv2.CAP_PROP_FOURCC))
+        self.pixel_format = ''.join(chr((fourcc >> (8 * i)) & 0xFF) for i in range(4))
+
+        # The raw mode is supported only for the known formats,
+        # and not all backends can turn the conversion off.
+        self.raw = False
+        if raw and self.pixel_format in ('YUYV', 'MJPG'):
+            self.raw = bool(self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 0))
+
+    def luma(self, frame):
+        """Get the grayscale (luma) image of a frame returned by read()."""
+        if not self.raw:
+            return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if self.pixel_format == 'MJPG':
+            # The JPEG stores luma separately, so the decoder skips the chroma.
+            return cv2.imdecode(np.frombuffer(frame, np.uint8), cv2.IMREAD_GRAYSCALE)
+        return cv2.cvtColor(frame.reshape(self.height, self.width, 2), cv2.COLOR_YUV2GRAY_YUYV)
+
+    def bgr(self, frame):
+        """Get the color image of a frame returned by read() (for preview)."""
+        if not self.raw:
+            return frame
+        if self.pixel_format == 'MJPG':
+            return cv2.imdecode(np.frombuffer(frame, np.uint8), cv2.IMREAD_COLOR)
+        return cv2.cvtColor(frame.reshape(self.height, self.width, 2), cv2.COLOR_YUV2BGR_YUYV)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *unused_args):
+        self.release()
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='FrameGrabber')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while self._running and self.cap.isOpened():
+            self._apply_controls()
+            ok, frame = self.cap.read()
+            # Take the timestamp as close to the capture moment as we can.
+            timestamp = time.time()
+            if not ok:
+                break
+            self.buffer.put(frame, timestamp)
+            self._read_props()
+        self._running = False
+        self.buffer.close()
+        with self._props_cond:
+            self._props_cond.notify_all()
+
+    def _apply_controls(self):
+        try:
+            while True:
+                prop_id, value = self._controls.get_nowait()
+                self.cap.set(prop_id, value)
+        except queue.Empty:
+            pass
+
+    def _read_props(self):
+        with self._props_cond:
+            prop_ids = list(self._props)
+        values = {prop_id: self.cap.get(prop_id) for prop_id in prop_ids}
+        with self._props_cond:
+            self._props.update(values)
+            self._props_cond.notify_all()
+
+    def _threaded(self):
+        """Whether the camera belongs to the grabber thread now."""
+        return self._thread is not None and self._thread.is_alive()
+
+    def is_open(self):
+        return self._running and self.cap.isOpened()
+
+    def read(self, timeout=1.0):
+        """Return the newest (frame, timestamp), or (None, None) on failure."""
+        if self._thread is None:
+            self.start()
+        return self.buffer.take(timeout)
+
+    def get(self, prop_id, timeout=1.0):
+        """Get a camera property.
+
+        While the grabber thread runs, it is the value read after the last
+        frame (the first get() of a property waits for the next frame).
+        """
+        if not self._threaded():
+            return self.cap.get(prop_id)
+        with self._props_cond:
+            if prop_id not in self._props:
+                self._props[prop_id] = None
+            self._props_cond.wait_for(
+                lambda: self._props[prop_id] is not None or not self._threaded(), timeout)
+            value = self._props[prop_id]
+        # Like cv2, return 0 for a property that can't be read.
+        return 0.0 if value is None else value
+
+    def set(self, prop_id, value):
+        """Set a camera property (on the grabber thread, before the next frame)."""
+        if not self._threaded():
+            return self.cap.set(prop_id, value)
+        self._controls.put((prop_id, value))
+        return True
+
+    def stats(self):
+        b = self.buffer
+        return "captured: {}, dropped: {}, age: {:1.1f} ms (max {:1.1f} ms)".format(
+            b.produced, b.dropped, b.last_age * 1000, b.max_age * 1000)
+
+    def release(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.buffer.close()
+        self.cap.release()
@@ -0,0 +1,168 @@
+"""Sending effect values at a control rate that doesn't depend on the video fps.
+
+The FxModulator computes the effect values once per video frame (~30 Hz).
+Sent as is, every value is a step, and a filter sweep sounds like a staircase
+("zipper noise"). The ControlRateEngine gets the values from the processing
+loop (submit()), and on its own thread sends values to the FxChanger at
+a higher rate (e.g. 200 Hz), with the values in between computed from the
+last two frames:
+ - interpolation: the values are delayed by one frame interval, and moved
+   linearly from the previous frame values to the last frame values,
+   so the curve is smooth, but one frame late
+ - extrapolation: the values are moved along the line through the last two
+   frame values (for a limited time), so there is no extra delay, but the
+   curve may overshoot when the motion changes. When a new frame comes,
+   the values are blended from the old line to the new one during one frame
+   interval, so they don't jump.
+
+Usage:
+>>> engine = ControlRateEngine(fx_changer, rate=200)
+>>> engine.start()
+>>> while True:
+>>>     ... (capture a frame and compute the values)
+>>>     engine.submit((A, B, C), frame_timestamp)
+"""
+
+import threading
+import time
+
+import numpy as np
+
+__all__ = ['ControlRateEngine', 'CONTROL_RATE']
+
+CONTROL_RATE = 200
+
+# Don't extrapolate the values further than this (in seconds) after the last
+# frame, e.g. when the processing loop is stalled.
+MAX_EXTRAPOLATION = 0.1
+
+
+class ControlRateEngine:
+
+    def __init__(self, fx_changer, rate=CONTROL_RATE, extrapolate=False,
+                 max_extrapolation=MAX_EXTRAPOLATION):
+        self.fx_changer = fx_changer
+        self.rate = rate
+        self.extrapolate = extrapolate
+        self.max_extrapolation = max_extrapolation
+        self.ticks = 0
+        self.late_ticks = 0
+
+        self._lock = threading.Lock()
+        self._prev = None  # (timestamp, values) of the previous frame
+        self._last = None  # (timestamp, values) of the last frame
+        self._output = None  # the last computed values
+        self._blend_from = None  # (time, values) when the last frame came
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='ControlRateEngine')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, values, timestamp):
+        """Pass the values computed for a frame captured at @timestamp."""
+        with self._lock:
+            self._prev = self._last
+            self._last = (timestamp, np.array(values, dtype=np.float64))
+            if self._output is not None:
+                self._blend_from = (time.time(), self._output)
+
+    def value_at(self, now):
+        """Compute the values to be sent at the moment @now (or None)."""
+        with self._lock:
+            prev, last, blend_from = self._prev, self._last, self._blend_from
+        if last is None:
+            return None
+        if prev is None or last[0] <= prev[0]:
+            self._output = last[1]
+            return self._output
+
+        (t0, v0), (t1, v1) = prev, last
+        dt = t1 - t0
+        if self.extrapolate:
+            frac = min((now - t0) / dt, 1.0 + self.max_extrapolation / dt)
+        else:
+            frac = min((now - dt - t0) / dt, 1.0)
+        frac = max(frac, 0.0)
+        values = v0 + (v1 - v0) * frac
+
+        if self.extrapolate and blend_from is not None:
+            blend_start, blend_values = blend_from
+            weight = min(max((now - blend_start) / dt, 0.0), 1.0)
+            values = blend_values + (values - blend_values) * weight
+
+        self._output = np.clip(values, 0.0, 1.0)
+        return self._output
+
+    def _run(self):
+        next_time = time.time()
+        while self._running:
+            now = time.time()
+            values = self.value_at(now)
+            if values is not None:
+                self.fx_changer.set_all(values, now)
+            self.fx_changer.flush()
+            self.ticks += 1
+
+            next_time += 1.0 / self.rate
+            delay = next_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                self.late_ticks += 1
+                next_time = time.time()  # too slow, don't try to catch up
+
+    def stats(self):
+        return "Control rate: {} Hz, ticks: {}, late: {}".format(
+            self.rate, self.ticks, self.late_ticks)
+
+
+# =============================================================================
+#  test/demo
+# =============================================================================
+# When the file is executed, feed a slow sine wave at 30 fps, and compare the
+# largest value steps sent per frame and at the control rate.
+
+if __name__ == '__main__':
+
+    class FakeFxChanger:
+        def __init__(self):
+            self.sent = []
+
+        def set_all(self, values, timestamp=None):
+            self.sent.append(float(values[0]))
+
+        def flush(self):
+            pass
+
+    def max_step(values):
+        return np.abs(np.diff(values)).max()
+
+    for extrapolate in (False, True):
+        fx_changer = FakeFxChanger()
+        engine = ControlRateEngine(fx_changer, extrapolate=extrapolate)
+        engine.start()
+        frame_values = []
+        for n in range(30):
+            value = 0.5 + 0.4 * np.sin(n / 30.0 * 2 * np.pi)
+            frame_values.append(value)
+            engine.submit((value,), time.time())
+            time.sleep(1.0 / 30)
+        engine.stop()
+
+        print("extrapolate: {}".format(extrapolate))
+        print("  per frame:    {} values, max step {:1.3f}".format(
+            len(frame_values), max_step(frame_values)))
+        print("  control rate: {} values, max step {:1.3f}".format(
+            len(fx_changer.sent), max_step(fx_changer.sent)))
+        print("  " + engine.stats())
+        assert max_step(fx_changer.sent) < max_step(frame_values)
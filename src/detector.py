@@ -0,0 +1,491 @@
+"""Detection of bright lights (blobs) in a camera frame.
+
+Each detector takes a thresholded (binary) image and returns a LightTable:
+a set of parallel NumPy arrays with one row per detected light.
+That keeps the per-frame cost out of Python loops, so a crowd of hundreds of
+phone lights doesn't slow down the processing loop.
+
+There are four detectors:
+ - ContourDetector - the original cv2.findContours() based one.
+   It loops over contours in Python, but the area/radius are exact
+   (cv2.contourArea() and cv2.minEnclosingCircle()).
+ - ComponentsDetector - based on cv2.connectedComponentsWithStats().
+   All the per-blob work is done in C++ and filtered with NumPy.
+   The area is the number of pixels in the blob, and the radius is the
+   half of the longer bounding box side (a cheap enclosing-circle estimate,
+   close to the exact one for round lights).
+ - StripedDetector - the same as ComponentsDetector, but the frame is split
+   into horizontal stripes that are processed in parallel, and blobs that
+   cross stripe borders are merged. The result is the same as the one of
+   ComponentsDetector (only the order of lights may differ).
+ - PyramidDetector - a coarse-to-fine detector. It looks for candidate
+   lights on a downscaled frame, and then detects lights at full resolution
+   only in small regions around the candidates. Most of the frame is a dark
+   stage background, so it is much cheaper than processing every pixel.
+   Unlike others, it takes a grayscale frame (not a thresholded one).
+
+For high-resolution cameras the preprocessing (median blur) is expensive too,
+so there is the StripedPreprocessor, a parallel version of preprocess().
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import cv2
+
+__all__ = ['LightTable', 'preprocess', 'ContourDetector', 'ComponentsDetector',
+           'StripedPreprocessor', 'StripedDetector', 'PyramidDetector']
+
+MIN_AREA = 50
+MAX_AREA = 5000
+BLUR_KSIZE = 15
+THRESHOLD_PERCENT = 0.7
+THRESHOLD_MIN = 48
+
+
+class LightTable:
+    """Detected lights stored as arrays:
+        centers - float32 array of shape (N, 2): x, y
+        radii   - float32 array of shape (N,)
+        areas   - float32 array of shape (N,)
+        bboxes  - int32 array of shape (N, 4): x, y, w, h
+    """
+
+    def __init__(self, centers, radii, areas, bboxes):
+        self.centers = centers
+        self.radii = radii
+        self.areas = areas
+        self.bboxes = bboxes
+
+    @staticmethod
+    def from_centers(centers, radius=5.0, area=80.0):
+        """Lights of the same size at the given @centers (for simulations)."""
+        n = len(centers)
+        return LightTable(np.asarray(centers, np.float32),
+                          np.full(n, radius, np.float32),
+                          np.full(n, area, np.float32),
+                          np.zeros((n, 4), np.int32))
+
+    @staticmethod
+    def empty():
+        return LightTable(np.zeros((0, 2), np.float32),
+                          np.zeros(0, np.float32),
+                          np.zeros(0, np.float32),
+                          np.zeros((0, 4), np.int32))
+
+    def __len__(self):
+        return len(self.radii)
+
+    def scaled(self, factor):
+        """Convert coordinates, e.g. from a downscaled frame to the full one."""
+        return LightTable(self.centers * factor,
+                          self.radii * factor,
+                          self.areas * (factor * factor),
+                          np.round(self.bboxes * factor).astype(np.int32))
+
+    def __getitem__(self, mask_or_indices):
+        """Select rows, e.g. table[table.areas > 100]"""
+        return LightTable(self.centers[mask_or_indices],
+                          self.radii[mask_or_indices],
+                          self.areas[mask_or_indices],
+                          self.bboxes[mask_or_indices])
+
+
+def calc_threshold(gray, threshold_percent=THRESHOLD_PERCENT):
+    """The threshold is a percent of the brightest pixel of the frame."""
+    [min_val, max_val, min_loc, max_loc] = cv2.minMaxLoc(gray)
+    return int(np.clip(int(max_val * threshold_percent), THRESHOLD_MIN, 255))
+
+
+def preprocess(gray, blur_ksize=BLUR_KSIZE, thresh=None):
+    """Blur and threshold a grayscale frame, return a binary image."""
+    if thresh is None:
+        thresh = calc_threshold(gray)
+    blur = cv2.medianBlur(gray, blur_ksize)
+    ret, thresh_img = cv2.threshold(blur, thresh, 255, cv2.THRESH_BINARY)
+    return thresh_img
+
+
+class ContourDetector:
+
+    def __init__(self, min_area=MIN_AREA, max_area=MAX_AREA):
+        self.min_area = min_area
+        self.max_area = max_area
+
+    def detect(self, thresh_img):
+        # findContours() returns 3 values in OpenCV 3 and 2 values in OpenCV 4
+        contours = cv2.findContours(thresh_img, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)[-2]
+
+        centers = []
+        radii = []
+        areas = []
+        bboxes = []
+        for c in contours:
+            area = cv2.contourArea(c)
+            if (area >= self.min_area and area <= self.max_area):
+                center, radius = cv2.minEnclosingCircle(c)
+                centers.append(center)
+                radii.append(radius)
+                areas.append(area)
+                bboxes.append(cv2.boundingRect(c))
+
+        if not areas:
+            return LightTable.empty()
+        return LightTable(np.array(centers, np.float32),
+                          np.array(radii, np.float32),
+                          np.array(areas, np.float32),
+                          np.array(bboxes, np.int32))
+
+
+class ComponentsDetector:
+
+    def __init__(self, min_area=MIN_AREA, max_area=MAX_AREA, connectivity=8):
+        self.min_area = min_area
+        self.max_area = max_area
+        self.connectivity = connectivity
+
+    def detect(self, thresh_img):
+        n, labels, stats, centroids = cv2.connectedComponentsWithStats(
+            thresh_img, connectivity=self.connectivity)
+        return self.table_from_stats(stats[1:], centroids[1:])  # 0 is the background
+
+    def table_from_stats(self, stats, centroids):
+        """Filter connectedComponentsWithStats() output by area, make a table."""
+        areas = stats[:, cv2.CC_STAT_AREA]
+        mask = (areas >= self.min_area) & (areas <= self.max_area)
+        stats = stats[mask]
+
+        bboxes = stats[:, :4].astype(np.int32)  # LEFT, TOP, WIDTH, HEIGHT
+        radii = np.maximum(bboxes[:, 2], bboxes[:, 3]).astype(np.float32) / 2
+        return LightTable(centroids[mask].astype(np.float32),
+                          radii,
+                          stats[:, cv2.CC_STAT_AREA].astype(np.float32),
+                          bboxes)
+
+
+class PyramidDetector(ComponentsDetector):
+    """Detect candidates on a downscaled frame, refine them at full resolution.
+
+    The bright regions of the downscaled image are grown by a margin, and
+    regions that touch each other are merged, so every light is entirely
+    inside a single region of interest (ROI). Then the usual blur, threshold
+    and connected components are done at full resolution inside every ROI.
+
+    The min_area/max_area are always in full-resolution pixels.
+    Since the downscaling averages pixels, small lights look dimmer on the
+    downscaled image, so the candidates are thresholded with a lower threshold
+    (coarse_threshold_factor of the normal one).
+    """
+
+    def __init__(self, scale=0.25, min_area=MIN_AREA, max_area=MAX_AREA,
+                 blur_ksize=BLUR_KSIZE, coarse_threshold_factor=0.5, margin=4):
+        ComponentsDetector.__init__(self, min_area, max_area, connectivity=8)
+        self.scale = scale
+        self.blur_ksize = blur_ksize
+        # The coarse blur must not be wider than the full one (in full-resolution
+        # pixels), otherwise it erases the smallest lights.
+        self.coarse_blur_ksize = max(3, (int(blur_ksize * scale) - 1) | 1)
+        self.coarse_threshold_factor = coarse_threshold_factor
+        # The ROI must include the blur neighbourhood of the light pixels,
+        # so the blur inside the ROI is the same as on the whole frame.
+        margin = margin + blur_ksize // 2
+        coarse_margin = int(np.ceil(margin * scale)) + 1
+        self.dilate_kernel = np.ones((2 * coarse_margin + 1, 2 * coarse_margin + 1), np.uint8)
+        self.thresh_img = None  # the last downscaled thresholded image
+        self.roi_labels = None  # the ROI labels of the downscaled image (ROI k is k + 1)
+
+    def detect_gray(self, gray):
+        thresh = calc_threshold(gray)
+        height, width = gray.shape[:2]
+
+        all_stats = []
+        all_centroids = []
+        rois = self.find_rois(gray, thresh)
+        roi_labels = self.roi_labels
+        small_height, small_width = roi_labels.shape[:2]
+        for k, (x0, y0, x1, y1) in enumerate(rois):
+            roi_thresh = preprocess(gray[y0:y1, x0:x1], self.blur_ksize, thresh)
+            n, labels, stats, centroids = cv2.connectedComponentsWithStats(roi_thresh, connectivity=8)
+            stats = stats[1:].astype(np.int64)
+            centroids = centroids[1:]
+            # Blobs cut by the ROI border are parts of lights that were too
+            # dim to be candidates (unless the ROI border is the frame border).
+            left = stats[:, cv2.CC_STAT_LEFT]
+            top = stats[:, cv2.CC_STAT_TOP]
+            right = left + stats[:, cv2.CC_STAT_WIDTH]
+            bottom = top + stats[:, cv2.CC_STAT_HEIGHT]
+            cut = (((left == 0) & (x0 > 0)) | ((top == 0) & (y0 > 0)) |
+                   ((right == x1 - x0) & (x1 < width)) | ((bottom == y1 - y0) & (y1 < height)))
+            centroids = centroids + (x0, y0)
+            # The bounding boxes of ROIs may overlap (e.g. a light in the
+            # corner of an L-shaped cluster), so a light may be entirely
+            # inside several ROIs. It belongs only to the ROI of its own label.
+            small_x = np.minimum((centroids[:, 0] * small_width / width).astype(np.int64),
+                                 small_width - 1)
+            small_y = np.minimum((centroids[:, 1] * small_height / height).astype(np.int64),
+                                 small_height - 1)
+            keep = ~cut & (roi_labels[small_y, small_x] == k + 1)
+            stats[:, cv2.CC_STAT_LEFT] += x0
+            stats[:, cv2.CC_STAT_TOP] += y0
+            all_stats.append(stats[keep])
+            all_centroids.append(centroids[keep])
+
+        if not all_stats:
+            return LightTable.empty()
+        return self.table_from_stats(np.concatenate(all_stats), np.concatenate(all_centroids))
+
+    def find_rois(self, gray, thresh):
+        """Return full-resolution x0, y0, x1, y1 boxes of regions to refine.
+
+        The ROI k is the component k + 1 of the downscaled 'roi_labels' image.
+        """
+        small = cv2.resize(gray, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        coarse_thresh = int(thresh * self.coarse_threshold_factor)
+        self.thresh_img = preprocess(small, self.coarse_blur_ksize, coarse_thresh)
+
+        # Grow the bright regions by the margin; grown regions that overlap
+        # become a single connected component, i.e. a single ROI.
+        grown = cv2.dilate(self.thresh_img, self.dilate_kernel)
+        n, labels, stats, centroids = cv2.connectedComponentsWithStats(grown, connectivity=8)
+        self.roi_labels = labels
+        stats = stats[1:]
+
+        # cv2.resize() rounds the downscaled size, so the real ratio is not
+        # exactly 1 / scale (otherwise the boxes stop short of the frame edge).
+        height, width = gray.shape[:2]
+        x_ratio = width / small.shape[1]
+        y_ratio = height / small.shape[0]
+        boxes = np.empty((len(stats), 4), np.int64)
+        boxes[:, 0] = np.floor(stats[:, cv2.CC_STAT_LEFT] * x_ratio)
+        boxes[:, 1] = np.floor(stats[:, cv2.CC_STAT_TOP] * y_ratio)
+        boxes[:, 2] = np.ceil((stats[:, cv2.CC_STAT_LEFT] + stats[:, cv2.CC_STAT_WIDTH]) * x_ratio)
+        boxes[:, 3] = np.ceil((stats[:, cv2.CC_STAT_TOP] + stats[:, cv2.CC_STAT_HEIGHT]) * y_ratio)
+        np.clip(boxes[:, 0::2], 0, width, out=boxes[:, 0::2])
+        np.clip(boxes[:, 1::2], 0, height, out=boxes[:, 1::2])
+        return boxes
+
+
+# =============================================================================
+#  parallel (striped) processing
+# =============================================================================
+# OpenCV functions release the GIL, so a thread pool is enough to run them on
+# all CPU cores, and the stripes don't have to be copied between processes.
+
+def stripe_bounds(height, stripes):
+    """Split the rows range into @stripes nearly equal [y0, y1) ranges."""
+    stripes = max(1, min(stripes, height))
+    rows = np.linspace(0, height, stripes + 1).astype(int)
+    return list(zip(rows[:-1], rows[1:]))
+
+
+class StripedPreprocessor:
+    """A parallel preprocess(): blur and threshold stripes of the frame.
+
+    Each stripe is blurred together with blur_ksize/2 rows of its neighbours,
+    so every pixel sees exactly the same neighbourhood as in the whole frame,
+    and the result is identical to preprocess().
+    """
+
+    def __init__(self, stripes=None, blur_ksize=BLUR_KSIZE, pool=None):
+        self.stripes = stripes or os.cpu_count()
+        self.blur_ksize = blur_ksize
+        self.pool = pool or ThreadPoolExecutor(self.stripes)
+
+    def __call__(self, gray, thresh=None):
+        if thresh is None:
+            thresh = calc_threshold(gray)  # must be the same for all stripes
+        thresh_img = np.empty_like(gray)
+        bounds = stripe_bounds(gray.shape[0], self.stripes)
+        futures = [self.pool.submit(self._process_stripe, gray, thresh_img, y0, y1, thresh)
+                   for y0, y1 in bounds]
+        for f in futures:
+            f.result()
+        return thresh_img
+
+    def _process_stripe(self, gray, thresh_img, y0, y1, thresh):
+        pad = self.blur_ksize // 2
+        top = max(0, y0 - pad)
+        bottom = min(gray.shape[0], y1 + pad)
+        blur = cv2.medianBlur(gray[top:bottom], self.blur_ksize)
+        cv2.threshold(blur[y0 - top:y1 - top], thresh, 255, cv2.THRESH_BINARY,
+                      dst=thresh_img[y0:y1])
+
+
+class StripedDetector(ComponentsDetector):
+    """A parallel ComponentsDetector.
+
+    Connected components are labeled in every stripe independently.
+    Then components that touch each other across a stripe border are merged
+    (with 8-connectivity), and their stats (area, bbox, centroid) are combined.
+    """
+
+    def __init__(self, stripes=None, min_area=MIN_AREA, max_area=MAX_AREA, pool=None):
+        ComponentsDetector.__init__(self, min_area, max_area, connectivity=8)
+        self.stripes = stripes or os.cpu_count()
+        self.pool = pool or ThreadPoolExecutor(self.stripes)
+
+    def detect(self, thresh_img):
+        bounds = stripe_bounds(thresh_img.shape[0], self.stripes)
+        results = list(self.pool.map(
+            lambda b: cv2.connectedComponentsWithStats(thresh_img[b[0]:b[1]], connectivity=8),
+            bounds))
+
+        # Convert stripe-local labels to global ones (the background is dropped).
+        offsets = np.cumsum([0] + [n - 1 for n, _, _, _ in results])
+        all_stats = []
+        all_centroids = []
+        for (y0, y1), (n, labels, stats, centroids) in zip(bounds, results):
+            stats = stats[1:].astype(np.int64)
+            stats[:, cv2.CC_STAT_TOP] += y0
+            centroids = centroids[1:].copy()
+            centroids[:, 1] += y0
+            all_stats.append(stats)
+            all_centroids.append(centroids)
+        stats = np.concatenate(all_stats)
+        centroids = np.concatenate(all_centroids)
+
+        roots = self._merge_borders(results, offsets, len(stats))
+        stats, centroids = self._combine(stats, centroids, roots)
+        return self.table_from_stats(stats, centroids)
+
+    @staticmethod
+    def _merge_borders(results, offsets, count):
+        """Find the root label of every global label (a union-find)."""
+        parent = np.arange(count)
+
+        def find(a):
+            while parent[a] != a:
+                parent[a] = parent[parent[a]]
+                a = parent[a]
+            return a
+
+        for i in range(len(results) - 1):
+            bottom = results[i][1][-1]      # the last row of the upper stripe
+            top = results[i + 1][1][0]      # the first row of the lower stripe
+            pairs = []
+            for dx in (-1, 0, 1):
+                a = bottom[max(0, -dx):len(bottom) - max(0, dx)]
+                b = top[max(0, dx):len(top) - max(0, -dx)]
+                touch = (a > 0) & (b > 0)
+                pairs.append(np.stack((a[touch] + offsets[i] - 1,
+                                       b[touch] + offsets[i + 1] - 1), axis=1))
+            # There are only a few blobs on a border, so a Python loop is OK.
+            for a, b in np.unique(np.concatenate(pairs), axis=0):
+                ra, rb = find(a), find(b)
+                if ra != rb:
+                    parent[max(ra, rb)] = min(ra, rb)
+
+        # Resolve the roots of all labels at once (pointer jumping).
+        while True:
+            grand_parent = parent[parent]
+            if (grand_parent == parent).all():
+                return parent
+            parent = grand_parent
+
+    @staticmethod
+    def _combine(stats, centroids, roots):
+        """Combine stats of labels that have the same root."""
+        merged = roots != np.arange(len(roots))
+        if not merged.any():
+            return stats, centroids
+
+        uniq, idx = np.unique(roots, return_inverse=True)
+        areas = stats[:, cv2.CC_STAT_AREA]
+        left = stats[:, cv2.CC_STAT_LEFT]
+        top = stats[:, cv2.CC_STAT_TOP]
+        right = left + stats[:, cv2.CC_STAT_WIDTH]
+        bottom = top + stats[:, cv2.CC_STAT_HEIGHT]
+
+        n = len(uniq)
+        new_left = np.full(n, np.iinfo(np.int64).max)
+        new_top = np.full(n, np.iinfo(np.int64).max)
+        new_right = np.zeros(n, np.int64)
+        new_bottom = np.zeros(n, np.int64)
+        np.minimum.at(new_left, idx, left)
+        np.minimum.at(new_top, idx, top)
+        np.maximum.at(new_right, idx, right)
+        np.maximum.at(new_bottom, idx, bottom)
+        new_areas = np.bincount(idx, weights=areas, minlength=n)
+
+        new_centroids = np.empty((n, 2))
+        new_centroids[:, 0] = np.bincount(idx, weights=centroids[:, 0] * areas, minlength=n) / new_areas
+        new_centroids[:, 1] = np.bincount(idx, weights=centroids[:, 1] * areas, minlength=n) / new_areas
+
+        new_stats = np.stack((new_left, new_top, new_right - new_left, new_bottom - new_top,
+                              new_areas.astype(np.int64)), axis=1)
+        return new_stats, new_centroids
+
+
+# =============================================================================
+#  test/demo
+# =============================================================================
+# When the file is executed, compare the striped processing with the
+# single-threaded one on a synthetic 4K frame, and print the timings.
+
+if __name__ == '__main__':
+    import time
+
+    rng = np.random.RandomState(0)
+    gray = rng.randint(0, 40, (2160, 3840)).astype(np.uint8)
+    for x, y, r in zip(rng.randint(0, 3840, 300), rng.randint(0, 2160, 300), rng.randint(6, 30, 300)):
+        cv2.circle(gray, (int(x), int(y)), int(r), 255, cv2.FILLED)
+
+    def timeit(fn, *args):
+        start = time.time()
+        for _n in range(10):
+            result = fn(*args)
+        return result, (time.time() - start) / 10 * 1000
+
+    thresh_img, t_pre = timeit(preprocess, gray)
+    table, t_det = timeit(ComponentsDetector().detect, thresh_img)
+    print("single:  preprocess %.1f ms, detect %.1f ms, %d lights" % (t_pre, t_det, len(table)))
+
+    for stripes in (2, 4, 8):
+        striped_pre = StripedPreprocessor(stripes)
+        s_thresh_img, t_pre = timeit(striped_pre, gray)
+        s_table, t_det = timeit(StripedDetector(stripes, pool=striped_pre.pool).detect, s_thresh_img)
+        print("striped: preprocess %.1f ms, detect %.1f ms, %d lights (%d stripes)" %
+              (t_pre, t_det, len(s_table), stripes))
+
+        assert (s_thresh_img == thresh_img).all()
+        order = np.lexsort((table.centers[:, 0], table.centers[:, 1]))
+        s_order = np.lexsort((s_table.centers[:, 0], s_table.centers[:, 1]))
+        assert (s_table.areas[s_order] == table.areas[order]).all()
+        assert (s_table.bboxes[s_order] == table.bboxes[order]).all()
+        assert np.allclose(s_table.centers[s_order], table.centers[order], atol=1e-3)
+
+    for scale in (0.5, 0.25):
+        p_table, t_det = timeit(PyramidDetector(scale).detect_gray, gray)
+        print("pyramid: detect %.1f ms, %d lights (scale %.2f)" % (t_det, len(p_table), scale))
+
+        p_order = np.lexsort((p_table.centers[:, 0], p_table.centers[:, 1]))
+        assert (p_table.bboxes[p_order] == table.bboxes[order]).all()
+
+    # An L-shaped cluster with a separate light in its corner: the bounding
+    # boxes of their ROIs overlap, but the light must be detected once.
+    gray = np.zeros((600, 800), np.uint8)
+    for n in range(12):
+        cv2.circle(gray, (100 + n * 25, 100), 8, 255, cv2.FILLED)
+        cv2.circle(gray, (100, 100 + n * 25), 8, 255, cv2.FILLED)
+    cv2.circle(gray, (300, 300), 8, 255, cv2.FILLED)
+    table = ComponentsDetector().detect(preprocess(gray))
+    order = np.lexsort((table.centers[:, 0], table.centers[:, 1]))
+    for scale in (0.5, 0.25):
+        p_table = PyramidDetector(scale).detect_gray(gray)
+        assert len(p_table) == len(table), (len(p_table), len(table))
+        p_order = np.lexsort((p_table.centers[:, 0], p_table.centers[:, 1]))
+        assert (p_table.bboxes[p_order] == table.bboxes[order]).all()
+
+    # Frame sizes that are not multiples of 1 / scale, with lights touching
+    # the right and bottom edges.
+    for scale in (0.5, 0.25):
+        for _n in range(50):
+            height, width = rng.randint(100, 300, 2)
+            gray = rng.randint(0, 40, (height, width)).astype(np.uint8)
+            for x, y in zip(rng.randint(0, width, 5), rng.randint(0, height, 5)):
+                cv2.circle(gray, (int(x), int(y)), int(rng.randint(6, 15)), 255, cv2.FILLED)
+            cv2.circle(gray, (int(width) - 3, int(height) - 3), 10, 255, cv2.FILLED)
+            table = ComponentsDetector().detect(preprocess(gray))
+            p_table = PyramidDetector(scale).detect_gray(gray)
+            assert len(p_table) == len(table), (width, height, len(p_table), len(table))
@@ -1,60 +1,273 @@
+import time
+
+import numpy as np
+
 from midi.output import MidiOutput
-from midi.msg import MidiCcMsg
+from midi.sender import MidiSender, MidiFanOut
+from midi.msg import MidiCcMsg, MidiBulkParamsMsg
+
+# The maximum number of messages per second for each controller.
+# A slow (DIN) MIDI interface passes only ~1000 messages per second in total.
+# It is twice the default control rate (see controlrate.py): at exactly the
+# control rate, every tick that comes a bit early (by the timer jitter) would
+# be held back, and the values would be stepped again.
+# None means "no limit".
+MAX_CC_RATE = 400
+
+# The MIDI output latency in milliseconds (see MidiOutput).
+# 0 - send messages immediately, as soon as the values are set.
+# >0 - send messages at the given timestamps + latency, so the jitter of the
+#      frame processing doesn't reach the wire (if it fits into the latency).
+MIDI_LATENCY = 0
+
+# The number of float values (from 0.0 to 1.0) in the response curve tables.
+CURVE_RESOLUTION = 4096
+
+
+# =============================================================================
+#  response curves
+# =============================================================================
+# A response curve maps the float effect value (0.0 to 1.0) to the controller
+# value (0.0 to 1.0), before it is converted to the 7-bit MIDI integer.
+# Some controllers (e.g. volume, filter cutoff) sound linear only with
+# a logarithmic or exponential curve.
+
+def curve_linear(x):
+    return x
+
+
+def curve_log(x, k=9.0):
+    """Rises fast at first, then slowly."""
+    return np.log1p(k * x) / np.log1p(k)
+
+
+def curve_exp(x, k=3.0):
+    """Rises slowly at first, then fast."""
+    return np.expm1(k * x) / np.expm1(k)
+
+
+def curve_s(x):
+    """Slow at both ends, fast in the middle (the "smoothstep")."""
+    return x * x * (3 - 2 * x)
+
+
+RESPONSE_CURVES = {
+    'linear': curve_linear,
+    'log': curve_log,
+    'exp': curve_exp,
+    's-curve': curve_s,
+}
+
+
+def make_curve_table(curve, resolution=CURVE_RESOLUTION):
+    """Compute the MIDI integer values of a curve for @resolution float values.
+
+    The @curve is a name from RESPONSE_CURVES, or a list of [x, y] breakpoints
+    (x ascending from 0.0 to 1.0), linearly interpolated between them.
+    """
+    x = np.linspace(0.0, 1.0, resolution)
+    if isinstance(curve, str):
+        if curve not in RESPONSE_CURVES:
+            raise ValueError("Unknown response curve: '%s'" % curve)
+        y = RESPONSE_CURVES[curve](x)
+    else:
+        points = np.array(curve, np.float64)
+        if points.ndim != 2 or points.shape[1] != 2 or np.any(np.diff(points[:, 0]) <= 0):
+            raise ValueError("A breakpoint curve must be a list of [x, y] with ascending x")
+        y = np.interp(x, points[:, 0], points[:, 1])
+    int_vals = np.round(np.clip(y, 0.0, 1.0) * MidiCcMsg.CC_VAL_MAX).astype(np.int64)
+    return [int(v) for v in int_vals]
+
+
+# =============================================================================
+#  effects
+# =============================================================================
 
 
 class MidiCcFx():
     """An effect that implemented with MIDI Control Change messages.
-    I.e. each change of the FX emits a corresponding MIDI CC message."""
+    I.e. each change of the FX emits a corresponding MIDI CC message.
 
-    @staticmethod
-    def map_float_to_int(float_val):
-        """
-        Convert a float value (of range 0.0 to 1.0) to a MIDI integer.
+    A message is emitted only when the MIDI value actually changes (after the
+    float value is mapped to the 7-bit integer).
 
-        The float value is much more abstract and better, so we use float when
-        we can, and convert it to MIDI integer only when we generate messages.
+    With @max_rate, at most max_rate messages per second are emitted.
+    Values set more often are coalesced: only the last one is kept (pending),
+    and it is emitted as soon as the rate allows it (by the next update() or
+    flush() call), or at once by flush(force=True), so the final value always
+    reaches the device. set() is not rate-limited (it is for single changes).
 
-        At this point the mapping is linear, but probably we will need some
-        non-linear (logarithmic, etc) mapping for certain controllers.
-        """
-        assert 0.00 <= float_val <= 1.00
-        int_val = int(round(float_val * MidiCcMsg.CC_VAL_MAX, 0))
-        return int_val
+    The 'sent' and 'suppressed' counters show how many values were emitted
+    and how many were skipped (unchanged or coalesced).
+
+    The float value is mapped to the MIDI value with a response @curve
+    (see make_curve_table()). The curve and all the messages are computed
+    (and checked) once, in the constructor, so setting a value costs only
+    a couple of table lookups. The messages are packed into integers
+    (see MidiMsg.pack()), and sent with MidiOutput.write_many_packed().
+    """
 
-    def __init__(self, midi_out, channel_num=0, controller_num=0, default_val=0.5):
+    def __init__(self, midi_out, channel_num=0, controller_num=0, default_val=0.5,
+                 max_rate=MAX_CC_RATE, curve='linear'):
         self.midi_out = midi_out
         self.channel_num = channel_num
         self.controller_num = controller_num
         self.default_val = default_val
+        self.min_interval = 1.0 / max_rate if max_rate else 0.0
+
+        # float value index -> MIDI value, MIDI value -> packed message
+        self.curve = curve
+        self._curve_table = make_curve_table(curve)
+        self._curve_scale = len(self._curve_table) - 1
+        self._msgs = [MidiCcMsg.make_packed(channel_num, controller_num, int_val)
+                      for int_val in range(MidiCcMsg.CC_VAL_MAX + 1)]
+
+        self.sent_val = None  # the last MIDI value sent to the device
+        self.sent_time = 0.0
+        self.pending_val = None  # the value that waits for the rate limit
+        self.sent = 0
+        self.suppressed = 0
+
+    def map_value(self, fx_val):
+        """Convert a float value (0.0 to 1.0) to the MIDI integer (via the curve).
+
+        Values out of the range are clamped.
+        """
+        idx = int(fx_val * self._curve_scale + 0.5)
+        if idx < 0:
+            idx = 0
+        elif idx > self._curve_scale:
+            idx = self._curve_scale
+        return self._curve_table[idx]
+
+    def _emit(self, int_val, now):
+        self.sent_val = int_val
+        self.sent_time = now
+        self.pending_val = None
+        self.sent += 1
+        return self._msgs[int_val]
+
+    def update(self, fx_val, now=None):
+        """Set a new value, return a packed message to send (or None to send nothing)."""
+        if now is None:
+            now = time.time()
+        int_val = self.map_value(fx_val)
+
+        if self.pending_val is not None:
+            # The pending value is replaced before it was sent.
+            self.suppressed += 1
+            self.pending_val = None
+
+        if int_val == self.sent_val:
+            self.suppressed += 1
+            return None
+        if now - self.sent_time < self.min_interval:
+            self.pending_val = int_val
+            return None
+        return self._emit(int_val, now)
+
+    def flush(self, now=None, force=False):
+        """Return the message with the pending value if the rate allows it
+        (or anyway, with @force)."""
+        if self.pending_val is None:
+            return None
+        if now is None:
+            now = time.time()
+        if not force and now - self.sent_time < self.min_interval:
+            return None
+        return self._emit(self.pending_val, now)
+
+    def update_now(self, fx_val, now=None):
+        """update() that is not held back by the rate limit."""
+        if now is None:
+            now = time.time()
+        msg = self.update(fx_val, now)
+        if msg is None:
+            msg = self.flush(now, force=True)
+        return msg
+
+    def current_val(self):
+        """The MIDI value the device has (the default one if nothing was sent)."""
+        return self.map_value(self.default_val) if self.sent_val is None else self.sent_val
 
     def set(self, fx_val):
-        int_val = MidiCcFx.map_float_to_int(fx_val)
-        msg = MidiCcMsg.make(self.channel_num, self.controller_num, int_val)
-        self.midi_out.write(msg)
+        """Send a new value at once (the rate limit doesn't hold it back)."""
+        now = time.time()
+        msg = self.update_now(fx_val, now)
+        if msg is not None:
+            self.midi_out.write_packed(msg, now)
 
     def reset(self):
         self.set(self.default_val)
 
 
 class FxChanger():
+    """Sets effects on one or several MIDI devices.
 
-    def __init__(self, device_id=0):
-        self.init_midi_out(device_id)
-        self.init_fx_list()
+    @device_id is a MIDI output device id, or a list of them (then the same
+    messages are sent to every device). A MidiOutput object (e.g. with
+    a MemoryBackend) can be given instead of a device id.
+    The messages are sent by MidiSender threads (one per device), so the
+    caller is never blocked by a device.
 
-    def init_midi_out(self, device_id):
-        self.midi_out = MidiOutput(device_id)
-        self.midi_out.open()
+    If a device accepts bulk parameter SysEx messages, give its @bulk_format:
+    the MidiBulkParamsMsg() arguments (manufacturer_id, device_id, command,
+    address, checksum). Then the values of all effects are sent to it in one
+    SysEx message (whenever any of them changes) instead of CC messages.
+    The @bulk_format is a list with an item for every device (None for the
+    devices that take CC messages), or a single dict for all of them.
+    """
+
+    def __init__(self, device_id=0, latency=MIDI_LATENCY, fx_specs=None, bulk_format=None):
+        self.init_midi_out(device_id, latency)
+        self.init_fx_list(fx_specs)
+        if not isinstance(bulk_format, (list, tuple)):
+            bulk_format = [bulk_format] * len(self.senders)
+        if len(bulk_format) != len(self.senders):
+            raise ValueError("Expected a bulk_format for each of %d devices" % len(self.senders))
+        # One item per device (per sender): a MidiBulkParamsMsg or None.
+        self.bulk_msgs = [None if fmt is None else MidiBulkParamsMsg(size=len(self.fx_list), **fmt)
+                          for fmt in bulk_format]
+
+    def init_midi_out(self, device_id, latency=MIDI_LATENCY):
+        device_ids = device_id if isinstance(device_id, (list, tuple)) else [device_id]
+        self.midi_outs = []
+        self.senders = []
+        for device_id in device_ids:
+            if isinstance(device_id, MidiOutput):
+                midi_out = device_id
+            else:
+                midi_out = MidiOutput(device_id, latency=latency)
+            midi_out.open()
+            sender = MidiSender(midi_out)
+            sender.start()
+            self.midi_outs.append(midi_out)
+            self.senders.append(sender)
+        self.midi_out = MidiFanOut(self.senders)
+
+    def close(self):
+        """Send the pending and queued messages and close the MIDI outputs."""
+        self.flush(force=True)
+        for sender in self.senders:
+            sender.stop()
+        for midi_out in self.midi_outs:
+            midi_out.close()
 
     class FX_ID:
         A = 0
         B = 1
         C = 2
 
-    def init_fx_list(self):
+    def init_fx_list(self, fx_specs=None):
+        """Create effects from @fx_specs: a list of MidiCcFx() keyword arguments
+        (e.g. from ModGraph.fx_specs()), or the default A/B/C effects."""
+        o = self.midi_out
+        if fx_specs is not None:
+            self.fx_list = [MidiCcFx(o, **spec) for spec in fx_specs]
+            return
+
         # MIDI channels/controllers are hardcoded.
         # TODO: make some GUI to adjust them.
-        o = self.midi_out
         self.fx_list = [
             MidiCcFx(o, channel_num=7, controller_num=0),
             MidiCcFx(o, channel_num=10, controller_num=1),
@@ -63,11 +276,152 @@ class FxChanger():
         ]
 
     def set(self, fx_id, fx_val):
-        """Set the (absolute) value of an effect (from 0.0 to 1.0)."""
-        fx = self.fx_list[fx_id]
-        fx.set(fx_val)
+        """Set the (absolute) value of an effect (from 0.0 to 1.0) at once,
+        regardless of the rate limit."""
+        now = time.time()
+        msg = self.fx_list[fx_id].update_now(fx_val, now)
+        self._send([] if msg is None else [msg], now)
+
+    def set_all(self, fx_vals, timestamp=None):
+        """Set values of all effects (in the fx_list order) at once.
+
+        All messages are sent in a single write, which is much cheaper
+        than calling set() for every effect.
+        Unchanged values are not sent at all (see MidiCcFx).
+
+        The @timestamp (in the time.time() scale) is the moment the values
+        belong to, e.g. the capture time of the frame. It is used only when
+        the output has a latency.
+        """
+        now = time.time() if timestamp is None else timestamp
+        msgs = []
+        for fx, fx_val in zip(self.fx_list, fx_vals):
+            msg = fx.update(fx_val, now)
+            if msg is not None:
+                msgs.append(msg)
+        self._send(msgs, timestamp)
+
+    def flush(self, force=False):
+        """Send the values that were held back by the rate limit.
+
+        Call it periodically when the values are not set for a while,
+        otherwise the last value of a burst may stay unsent.
+        With @force, the values are sent regardless of the rate limit
+        (close() does it, so the final values always reach the devices).
+        """
+        now = time.time()
+        msgs = []
+        for fx in self.fx_list:
+            msg = fx.flush(now, force)
+            if msg is not None:
+                msgs.append(msg)
+        # With an output latency, the messages without a timestamp would
+        # overtake the ones that are still waiting for their time.
+        self._send(msgs, now)
+
+    def _send(self, msgs, timestamp=None):
+        if not msgs:
+            return
+        values = None
+        for sender, bulk_msg in zip(self.senders, self.bulk_msgs):
+            if bulk_msg is None:
+                sender.write_many_packed(msgs, timestamp)
+                continue
+            # The whole state in one message; a newer one replaces a queued one.
+            if values is None:
+                values = [fx.current_val() for fx in self.fx_list]
+            sender.write_sysex(bulk_msg.make(values), timestamp, replace_key='bulk')
+
+    def stats(self):
+        sent = sum(fx.sent for fx in self.fx_list)
+        suppressed = sum(fx.suppressed for fx in self.fx_list)
+        return "MIDI messages sent: {}, suppressed: {}".format(sent, suppressed)
+
+    def sender_stats(self):
+        """Queue depths and send latencies, one line per device."""
+        return ["MIDI #{}: {}".format(midi_out.device_id, sender.stats())
+                for midi_out, sender in zip(self.midi_outs, self.senders)]
 
     def reset(self, fx_id):
         """Reset an effect to its default value."""
-        fx = self.fx_list[fx_id]
-        fx.reset()
+        self.set(fx_id, self.fx_list[fx_id].default_val)
+
+
+# =============================================================================
+#  test/demo
+# =============================================================================
+# When the file is executed, measure how many messages per second the
+# FxChanger can send (to a MemoryBackend, so no MIDI hardware is needed).
+
+if __name__ == '__main__':
+    from midi.output import MemoryBackend
+
+    N_FX = 32
+    N_FRAMES = 20000
+
+    memory = MemoryBackend()
+    fx_changer = FxChanger(MidiOutput(backend=memory),
+                           fx_specs=[dict(channel_num=n // 16, controller_num=n % 16, max_rate=None)
+                                     for n in range(N_FX)])
+    rng = np.random.RandomState(0)
+    values = rng.uniform(0, 1, (N_FRAMES, N_FX))
+
+    start = time.time()
+    for frame_values in values:
+        fx_changer.set_all(frame_values)
+    fx_changer.close()
+    elapsed = time.time() - start
+
+    # The sender coalesces the messages that come faster than it writes them.
+    produced = sum(fx.sent for fx in fx_changer.fx_list)
+    print("{} effects, {} updates: {:1.1f} us per update".format(
+        N_FX, N_FRAMES, elapsed / N_FRAMES * 1e6))
+    print("messages per second: {:1.0f} produced, {:1.0f} written to the backend".format(
+        produced / elapsed, memory.count / elapsed))
+    print(fx_changer.stats())
+    print(fx_changer.sender_stats()[0])
+
+    # The same with one bulk SysEx message per update instead of CCs.
+    memory = MemoryBackend()
+    fx_changer = FxChanger(MidiOutput(backend=memory),
+                           fx_specs=[dict(channel_num=n // 16, controller_num=n % 16, max_rate=None)
+                                     for n in range(N_FX)],
+                           bulk_format=dict(manufacturer_id=0x7D, device_id=0, command=0x12,
+                                            address=(0, 0), checksum=True))
+    start = time.time()
+    for frame_values in values:
+        fx_changer.set_all(frame_values)
+    fx_changer.close()
+    elapsed = time.time() - start
+
+    timestamp, last_sysex = memory.sysex[-1]
+    print("bulk SysEx: {:1.1f} us per update, {} messages of {} bytes written".format(
+        elapsed / N_FRAMES * 1e6, memory.sysex_count, len(last_sysex)))
+    expected = [fx.sent_val for fx in fx_changer.fx_list]
+    # F0, manufacturer, device, command, 2 address bytes, values...
+    assert list(last_sysex[6:6 + N_FX]) == expected
+
+    # The last values must reach the device, even if they were held back by
+    # the rate limit.
+    memory = MemoryBackend()
+    fx_changer = FxChanger(MidiOutput(backend=memory))
+    fx_changer.set_all([0.2] * 3)
+    fx_changer.set_all([0.8] * 3)
+    fx_changer.set(0, 0.3)
+    fx_changer.reset(0)
+    fx_changer.close()
+    last_values = {msg & 0xFFFF: msg >> 16 for msg in memory.recent()[1].tolist()}
+    assert [last_values[fx._msgs[0]] for fx in fx_changer.fx_list] == [64, 102, 102], last_values
+
+    # A device that takes CCs and a device that takes bulk messages.
+    cc_memory = MemoryBackend()
+    bulk_memory = MemoryBackend()
+    fx_changer = FxChanger([MidiOutput(backend=cc_memory), MidiOutput(backend=bulk_memory)],
+                           bulk_format=[None, dict(manufacturer_id=0x7D, device_id=0,
+                                                   command=0x12, address=(0, 0))])
+    fx_changer.set(0, 1.0)
+    fx_changer.close()
+    assert cc_memory.recent()[1].tolist() == [fx_changer.fx_list[0]._msgs[127]]
+    assert cc_memory.sysex_count == 0 and bulk_memory.count == 0
+    # The effects that were never set have their default values.
+    assert list(bulk_memory.sysex[-1][1][6:9]) == [127, 64, 64]
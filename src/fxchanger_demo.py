@@ -12,6 +12,8 @@ def run_demo():
         gradually_increase(fx_id, step=0.1, pause=0.5)
         wobble(fx_id, val1=0.3, val2=0.7, times=5, pause=1)
         wobble(fx_id, val1=0.1, val2=0.9, times=20, pause=0.1)
+    # the messages are sent on background threads, let them finish
+    fxchanger.close()
 
 
 def gradually_increase(fx_id, step, pause):
@@ -0,0 +1,189 @@
+"""Conversion of the tracked lights motion into effect values (A, B, C).
+
+C is the coherence of the lights motion in the current frame, and A and B
+follow C slowly, with an exponential attack (when C is above them) and decay
+(when C is below them). The attack/decay time constants are in seconds, and
+the modulate() takes the time since the previous frame (dT), so A and B
+change at the same musical pace at any fps (and with skipped frames).
+
+There are two equivalent ways to call it:
+ - modulate() takes a list of tracks.Light objects (slow, a Python loop
+   to gather the velocities)
+ - modulate_arrays() takes the per-track arrays (e.g. of a TrackSnapshot),
+   and computes everything with numpy (fast, for hundreds of tracks)
+"""
+
+import math
+
+import numpy as np
+
+from vector import VectorArray
+from tracks import SPEED_THRESHOLD, MATURITY_TIME
+
+__all__ = ['FxModulator']
+
+# Time constants in seconds: the time to move ~63% of the way to C.
+ATTACK_TIME_A = 4.0
+DECAY_TIME_A = 10.0
+ATTACK_TIME_B = 2.0
+DECAY_TIME_B = 5.0
+
+
+def follow(value, target, dT, attack_time, decay_time):
+    """Move the @value towards the @target during dT seconds (exponentially)."""
+    time_constant = attack_time if target > value else decay_time
+    return target + (value - target) * math.exp(-dT / time_constant)
+
+
+class FxModulator:
+    def __init__(self, debug=False):
+        self.accumulated_A = 0
+        self.accumulated_B = 0
+        self.debug = debug
+
+    def modulate(self, lights_list, dT):
+        velocities = []
+        for light in lights_list:
+            if (not light.is_significant()):
+                continue
+            vec = light.vec()
+            velocities.append((vec.end.x - vec.start.x, vec.end.y - vec.start.y))
+        velocities = VectorArray(velocities)
+
+        summ_vel_magnitude = velocities.sum().norm()
+        summ_length = velocities.norm().sum()
+        return self._accumulate(summ_vel_magnitude, summ_length, dT)
+
+    def modulate_arrays(self, velocities, dts, ages, dT):
+        """The vectorized modulate().
+
+        velocities - (N, 2) array: the last displacement of each track
+        dts        - (N,) array: the time of this displacement
+        ages       - (N,) array: the time since each track was born
+        (these are the TrackSnapshot attributes of the same name)
+        """
+        lengths = np.hypot(velocities[:, 0], velocities[:, 1])
+        speeds = np.divide(lengths, dts, out=np.zeros_like(lengths), where=dts > 0)
+        significant = (speeds > SPEED_THRESHOLD) & (ages > MATURITY_TIME)
+
+        summ_velocity = velocities[significant].sum(axis=0)
+        summ_length = lengths[significant].sum()
+        summ_vel_magnitude = math.hypot(summ_velocity[0], summ_velocity[1])
+        return self._accumulate(summ_vel_magnitude, summ_length, dT)
+
+    def modulate_snapshot(self, snap, dT):
+        """modulate_arrays() for a tracks.TrackSnapshot."""
+        return self.modulate_arrays(snap.velocities, snap.dts, snap.ages, dT)
+
+    def _accumulate(self, summ_vel_magnitude, summ_length, dT):
+        # some kind of velocity coherence
+
+        # C - fast moving fx (period should be about 0.5..1s)
+        if summ_length > 0:
+            coherence = summ_vel_magnitude / summ_length  # should be in range 0..1
+            self.accumulated_C = coherence
+        else:
+            coherence = 0
+            self.accumulated_C = 0
+
+        # A - very slow moving fx (period should be about 10 sec)
+        self.accumulated_A = follow(self.accumulated_A, self.accumulated_C, dT,
+                                    ATTACK_TIME_A, DECAY_TIME_A)
+
+        # B - middle-speed moving fx (period should be about 5 sec)
+        self.accumulated_B = follow(self.accumulated_B, self.accumulated_C, dT,
+                                    ATTACK_TIME_B, DECAY_TIME_B)
+
+        self.accumulated_A = np.clip(self.accumulated_A, 0, 1.0)
+        self.accumulated_B = np.clip(self.accumulated_B, 0, 1.0)
+        self.accumulated_C = np.clip(self.accumulated_C, 0, 1.0)
+
+        if self.debug:
+            print("ABC=", self.accumulated_A, self.accumulated_B, self.accumulated_C)
+
+        return self.accumulated_A, self.accumulated_B, self.accumulated_C
+
+
+# =============================================================================
+#  test/demo
+# =============================================================================
+# When the file is executed, feed the same motion of lights (5 seconds of
+# coherent motion, then 5 seconds of chaotic motion) at 15, 30 and 60 fps,
+# and check that A and B are the same (the modulator doesn't depend on fps).
+# Then check that modulate() and modulate_arrays() give the same results,
+# and compare their speed.
+
+if __name__ == '__main__':
+    from detector import LightTable
+    from tracks import TrackStore
+
+    N_LIGHTS = 20
+    SPEED = 300  # pixels per second
+
+    def simulate(fps):
+        """Return (time, A, B, C) samples taken every second."""
+        rng = np.random.RandomState(0)
+        origins = rng.uniform(500, 1500, (N_LIGHTS, 2))
+        chaotic_angles = rng.uniform(0, 2 * np.pi, N_LIGHTS)
+        chaotic_dirs = np.stack((np.cos(chaotic_angles), np.sin(chaotic_angles)), axis=1)
+
+        start = 1000.0
+        tracks = TrackStore(timestamp=start)
+        modulator = FxModulator()
+        identity = np.arange(N_LIGHTS)
+        samples = []
+        for n in range(int(10 * fps) + 1):
+            t = n / fps
+            if t <= 5:
+                positions = origins + [SPEED * t, 0]
+            else:
+                positions = origins + [SPEED * 5, 0] + chaotic_dirs * SPEED * (t - 5)
+            matches = identity if n else np.full(N_LIGHTS, -1)
+            tracks.update(LightTable.from_centers(positions), matches, start + t)
+            A, B, C = modulator.modulate(tracks.lights(), 1.0 / fps)
+            if n % fps == 0:
+                samples.append((t, A, B, C))
+        return np.array(samples)
+
+    results = {fps: simulate(fps) for fps in (15, 30, 60)}
+    for fps, samples in results.items():
+        print("{} fps: A = {}".format(fps, np.round(samples[:, 1], 3)))
+        print("{} fps: B = {}".format(fps, np.round(samples[:, 2], 3)))
+
+    for fps in (15, 60):
+        diff = np.abs(results[fps][:, 1:3] - results[30][:, 1:3]).max()
+        print("max A/B difference between {} and 30 fps: {:1.4f}".format(fps, diff))
+        assert diff < 0.02
+
+    # Every light must continue its own matched track, also when the matched
+    # tracks are not in the order of the lights.
+    tracks = TrackStore(timestamp=1000.0)
+    origins = np.array([[0, 0], [100, 100], [300, 50], [700, 400]])
+    tracks.update(LightTable.from_centers(origins), np.full(len(origins), -1), 1000.0)
+    for order in ([0, 1, 2, 3], [2, 0, 3, 1], [3, 2, 1, 0]):
+        origins = origins[order] + 1
+        tracks.update(LightTable.from_centers(origins), np.array(order), tracks.timestamp + 0.1)
+        snap = tracks.snapshot()
+        assert np.allclose(snap.velocities, 1), snap.velocities
+
+    import timeit
+
+    for n_lights in (10, 100, 500):
+        rng = np.random.RandomState(1)
+        tracks = TrackStore(timestamp=1000.0)
+        for n in range(3):
+            positions = rng.uniform(0, 1000, (n_lights, 2))
+            matches = np.arange(n_lights) if n else np.full(n_lights, -1)
+            tracks.update(LightTable.from_centers(positions), matches, 1000.0 + n * 0.2)
+
+        lights = tracks.lights()
+        snap = tracks.snapshot()
+        loop_result = FxModulator().modulate(lights, 0.2)
+        arrays_result = FxModulator().modulate_snapshot(snap, 0.2)
+        assert np.allclose(loop_result, arrays_result), (loop_result, arrays_result)
+
+        modulator = FxModulator()
+        loop_time = min(timeit.repeat(lambda: modulator.modulate(lights, 0.03), number=20, repeat=3)) / 20
+        arrays_time = min(timeit.repeat(lambda: modulator.modulate_snapshot(snap, 0.03), number=20, repeat=3)) / 20
+        print("{} tracks: modulate(): {:1.3f} ms, modulate_arrays(): {:1.3f} ms".format(
+            n_lights, loop_time * 1000, arrays_time * 1000))
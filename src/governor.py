@@ -0,0 +1,104 @@
+"""Adaptive quality control for the processing loop.
+
+The frame processing time depends on the lighting and on the crowd size.
+When it exceeds the frame budget, the fps drops and the music reacts slower.
+The QualityGovernor() watches the processing time of every frame, and steps
+through a list of quality levels: it makes the processing cheaper when it
+doesn't fit into the budget, and restores the quality when there is
+enough headroom again. Every level change is logged.
+
+Usage:
+>>> governor = QualityGovernor(target_fps=30)
+>>> while True:
+>>>     level = governor.level
+>>>     ... (process a frame according to the level)
+>>>     governor.update(processing_time)
+"""
+
+__all__ = ['QualityLevel', 'QualityGovernor', 'DEFAULT_LEVELS']
+
+
+class QualityLevel:
+    """Processing parameters:
+        blur_ksize    - the median blur kernel size (in processed pixels)
+        scale         - the processing resolution (a fraction of the frame)
+        preview_every - divide the preview rate by N
+        detect_every  - detect lights on every Nth frame; on other frames
+                        the tracks are moved by their predicted velocity
+    """
+
+    def __init__(self, blur_ksize, scale, preview_every, detect_every):
+        self.blur_ksize = blur_ksize
+        self.scale = scale
+        self.preview_every = preview_every
+        self.detect_every = detect_every
+
+    def __str__(self):
+        return ("blur: {}, scale: {}, preview every {}, detect every {}"
+                .format(self.blur_ksize, self.scale, self.preview_every, self.detect_every))
+
+
+# From the best quality to the cheapest processing.
+DEFAULT_LEVELS = [
+    QualityLevel(blur_ksize=15, scale=1.0, preview_every=1, detect_every=1),
+    QualityLevel(blur_ksize=9, scale=1.0, preview_every=2, detect_every=1),
+    QualityLevel(blur_ksize=7, scale=0.5, preview_every=3, detect_every=1),
+    QualityLevel(blur_ksize=5, scale=0.5, preview_every=4, detect_every=2),
+    QualityLevel(blur_ksize=3, scale=0.25, preview_every=6, detect_every=3),
+]
+
+
+class QualityGovernor:
+    """Selects a quality level, so the frame processing time fits the budget.
+
+    The processing time is smoothed (an exponential moving average), and the
+    level is changed only after the time stays out of bounds for a number of
+    frames (@patience), so a single slow frame doesn't change anything.
+    The quality goes down when the average time exceeds the budget, and goes
+    up when it is below the budget * @headroom (slower, with 4x patience,
+    to avoid oscillation between two levels).
+    """
+
+    def __init__(self, target_fps=30, levels=DEFAULT_LEVELS,
+                 smoothing=0.1, patience=15, headroom=0.6):
+        self.budget = 1.0 / target_fps
+        self.levels = levels
+        self.smoothing = smoothing
+        self.patience = patience
+        self.headroom = headroom
+
+        self.level_idx = 0
+        self.avg_time = 0.0
+        self.slow_frames = 0
+        self.fast_frames = 0
+
+    @property
+    def level(self):
+        return self.levels[self.level_idx]
+
+    def update(self, frame_time):
+        """Account the processing time (in seconds) of the last frame."""
+        self.avg_time += (frame_time - self.avg_time) * self.smoothing
+
+        if self.avg_time > self.budget:
+            self.slow_frames += 1
+            self.fast_frames = 0
+        elif self.avg_time < self.budget * self.headroom:
+            self.fast_frames += 1
+            self.slow_frames = 0
+        else:
+            self.slow_frames = 0
+            self.fast_frames = 0
+
+        if self.slow_frames >= self.patience and self.level_idx < len(self.levels) - 1:
+            self.set_level(self.level_idx + 1)
+        elif self.fast_frames >= self.patience * 4 and self.level_idx > 0:
+            self.set_level(self.level_idx - 1)
+
+    def set_level(self, level_idx):
+        print("quality level {} -> {} ({}), avg frame time: {:1.1f} ms, budget: {:1.1f} ms"
+              .format(self.level_idx, level_idx, self.levels[level_idx],
+                      self.avg_time * 1000, self.budget * 1000))
+        self.level_idx = level_idx
+        self.slow_frames = 0
+        self.fast_frames = 0
@@ -0,0 +1,154 @@
+"""Drawing of the preview window: tracked lights, text messages, A/B/C plot."""
+
+import numpy as np
+import cv2
+
+__all__ = ['message', 'combine_images', 'draw_lights', 'Plot', 'OverlayCompositor']
+
+RECTANGLE_COLOR = (0, 255, 0)
+CIRCLE_COLOR = (255, 0, 0)
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+
+def message(msg, coord, frame):
+    cv2.putText(frame, msg, coord, FONT, 0.4, (255, 255, 255), 1, cv2.LINE_AA)
+
+
+def combine_images(src, dst, x, y):
+    for c in range(0, 3):
+        dst[y:y + src.shape[0], x:x + src.shape[1], c] = src[:, :, c] * (src[:, :, 3] / 255.0) + dst[y:y + src.shape[0],
+                                                                                                 x:x + src.shape[1],
+                                                                                                 c] * (1.0 - src[:, :,
+                                                                                                             3] / 255.0)
+
+
+def draw_lights(frame, snap):
+    """Draw significant lights of a tracks.TrackSnapshot over the frame."""
+    for i in snap.significant.nonzero()[0]:
+        x, y, w, h = (int(v) for v in snap.bboxes[i])
+        cx, cy = (float(v) for v in snap.centers[i])
+        px, py = (float(v) for v in snap.prev_centers[i])
+        dX = cx - px
+        dY = cy - py
+        color = tuple(int(v) for v in snap.colors[i])
+
+        cv2.arrowedLine(frame,
+                        (int(px + dX), int(py + dY)),
+                        (int(cx + dX * 2), int(cy + dY * 2)),
+                        RECTANGLE_COLOR, 2)
+        # center, radius = cv2.minEnclosingCircle(c)
+        # cv2.circle(frame, (int(center[0]),int(center[1])), int(radius), CIRCLE_COLOR, 2);
+        cv2.rectangle(frame, (x - 5, y - 5), (x + w + 5, y + h + 5), color, 2)
+        cv2.circle(frame, (int(cx), int(cy)), 2, CIRCLE_COLOR, 1)
+
+
+class OverlayCompositor:
+    """Blends static RGBA layers (the logo, HUD outlines) over frames.
+
+    Unlike combine_images(), everything that doesn't depend on the frame is
+    computed once, in add_layer():
+     - the layer is cropped to its non-transparent pixels,
+     - the colors are premultiplied by alpha, and the inverted alpha is
+       expanded to 3 channels,
+    so compose() does a single integer multiply-add per pixel, only over the
+    regions that are covered by the layers, into preallocated buffers.
+    """
+
+    def __init__(self):
+        self.layers = []
+
+    def add_layer(self, rgba, x, y):
+        alpha = rgba[:, :, 3]
+        rows = np.flatnonzero(alpha.any(axis=1))
+        cols = np.flatnonzero(alpha.any(axis=0))
+        if len(rows) == 0:
+            return
+        y0, y1 = rows[0], rows[-1] + 1
+        x0, x1 = cols[0], cols[-1] + 1
+        rgba = rgba[y0:y1, x0:x1]
+
+        alpha = rgba[:, :, 3:4].astype(np.uint16)
+        premultiplied = rgba[:, :, :3].astype(np.uint16) * alpha + 128
+        inv_alpha = np.repeat(255 - alpha, 3, axis=2)
+        buf = np.empty_like(premultiplied)
+        self.layers.append((x + x0, y + y0, premultiplied, inv_alpha, buf))
+
+    def compose(self, frame):
+        for x, y, premultiplied, inv_alpha, buf in self.layers:
+            h, w = premultiplied.shape[:2]
+            region = frame[y:y + h, x:x + w]
+            if region.shape[:2] != (h, w):
+                continue  # the layer doesn't fit into the frame
+            # buf = round((src * alpha + dst * (255 - alpha)) / 255)
+            # where x / 255 is computed as (x + (x >> 8)) >> 8 (exact for
+            # x < 65536, the +128 for rounding is added in add_layer()).
+            np.multiply(region, inv_alpha, out=buf)
+            buf += premultiplied
+            buf += buf >> 8
+            buf >>= 8
+            region[:] = buf
+
+
+class Plot:
+    def __init__(self, x, y, w, h):
+        self.x = x
+        self.y = y
+        self.w = w
+        self.h = h
+
+    def _geometry(self):
+        dW = self.w / 4
+        dH = self.h / 2
+        r = min(self.w, self.h) / 3
+        centers = [(int(self.x + dW * n), int(self.y + dH)) for n in (1, 2, 3)]
+        return centers, r
+
+    def static_layers(self):
+        """The outline circles as RGBA layers for the OverlayCompositor:
+        a list of (rgba, x, y) tuples."""
+        centers, r = self._geometry()
+        size = 2 * int(r) + 3
+        layers = []
+        for cx, cy in centers:
+            rgba = np.zeros((size, size, 4), np.uint8)
+            cv2.circle(rgba, (size // 2, size // 2), int(r), (255, 255, 255, 255), 1)
+            layers.append((rgba, cx - size // 2, cy - size // 2))
+        return layers
+
+    def draw_values(self, img, A, B, C):
+        """Draw only the value circles (the outlines are static layers)."""
+        centers, r = self._geometry()
+        colors = [(127, 127 + 20, 127 + 50), (127, 127 + 50, 127 + 20), (127 + 50, 127, 127 + 20)]
+        for center, val, color in zip(centers, (A, B, C), colors):
+            cv2.circle(img, center, int(val * r), color, cv2.FILLED)
+
+
+# =============================================================================
+#  test/demo
+# =============================================================================
+# When the file is executed, compare the OverlayCompositor with the
+# combine_images() on a 1080p frame, and print the timings.
+
+if __name__ == '__main__':
+    import time
+
+    logo = cv2.imread('logo.png', -1)
+    frame = np.random.RandomState(0).randint(0, 256, (1080, 1920, 3)).astype(np.uint8)
+    x, y = 1920 - 125, 10
+
+    expected = frame.copy()
+    combine_images(logo, expected, x, y)
+    compositor = OverlayCompositor()
+    compositor.add_layer(logo, x, y)
+    composed = frame.copy()
+    compositor.compose(composed)
+    diff = np.abs(composed.astype(int) - expected.astype(int)).max()
+    print("max difference from combine_images(): %d" % diff)
+    assert diff <= 1  # combine_images() truncates, the compositor rounds
+
+    for name, fn in (('combine_images', lambda f: combine_images(logo, f, x, y)),
+                     ('OverlayCompositor', compositor.compose)):
+        start = time.time()
+        for _n in range(1000):
+            fn(frame)
+        print("%s: %.1f us per frame" % (name, (time.time() - start) * 1000))
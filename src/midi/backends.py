@@ -0,0 +1,205 @@
+"""MidiOutput backends that don't need any MIDI hardware.
+
+ - MemoryBackend - keeps the last messages in a ring buffer in memory
+                   (for benchmarks and tests)
+ - MidiFileRecorder - records the messages with their timestamps to a file:
+                      a Standard MIDI File (.mid) or a raw binary file
+
+Any object with the same methods (open/is_open/close/write/write_many/
+write_sysex) and attributes (device_id/device_name/interface_name) can be a backend.
+The messages come to a backend packed into integers:
+    status | (data1 << 8) | (data2 << 16)
+(write_many() gets a list of them or a numpy uint32 array),
+and the timestamps are in the time.time() scale (None means "now").
+
+Usage:
+>>> out = MidiOutput(backend=MemoryBackend())
+>>> with out:
+>>>     out.write_many([(0xB0, 1, 64), (0xB0, 2, 100)])
+>>> timestamps, msgs = out.backend.recent()
+"""
+
+import collections
+import os
+import struct
+import time
+
+import numpy as np
+
+__all__ = ['MemoryBackend', 'MidiFileRecorder']
+
+
+class MemoryBackend:
+    """Keeps the last @capacity messages (and their timestamps) in memory.
+
+    The 'count' is the number of all messages written since the creation.
+    SysEx messages are kept separately, in the 'sysex' list of the last
+    @sysex_capacity (timestamp, data) pairs, and counted in 'sysex_count'.
+    """
+
+    device_id = -1
+    device_name = 'ring buffer'
+    interface_name = 'memory'
+
+    def __init__(self, capacity=65536, sysex_capacity=1024):
+        self.capacity = capacity
+        self.timestamps = np.zeros(capacity, np.float64)
+        self.messages = np.zeros(capacity, np.uint32)
+        self.count = 0
+        self.sysex = collections.deque(maxlen=sysex_capacity)
+        self.sysex_count = 0
+        self._open = False
+
+    def open(self):
+        self._open = True
+
+    def is_open(self):
+        return self._open
+
+    def close(self):
+        self._open = False
+
+    def write(self, packed_msg, timestamp=None):
+        idx = self.count % self.capacity
+        self.timestamps[idx] = time.time() if timestamp is None else timestamp
+        self.messages[idx] = packed_msg
+        self.count += 1
+
+    def write_many(self, packed_msgs, timestamp=None):
+        # Only the last 'capacity' messages would survive anyway.
+        msgs = np.asarray(packed_msgs, np.uint32)[-self.capacity:]
+        self.count += len(packed_msgs)
+        idx = (self.count - len(msgs) + np.arange(len(msgs))) % self.capacity
+        self.timestamps[idx] = time.time() if timestamp is None else timestamp
+        self.messages[idx] = msgs
+
+    def write_sysex(self, data, timestamp=None):
+        self.sysex.append((time.time() if timestamp is None else timestamp, bytes(data)))
+        self.sysex_count += 1
+
+    def recent(self, n=None):
+        """Return (timestamps, messages) arrays of the last @n messages (oldest first)."""
+        available = min(self.count, self.capacity)
+        n = available if n is None else min(n, available)
+        idx = (self.count - n + np.arange(n)) % self.capacity
+        return self.timestamps[idx], self.messages[idx]
+
+
+class MidiFileRecorder:
+    """Records the messages to a file.
+
+    Every message is appended to a raw binary file as it comes:
+    a little-endian float64 timestamp (in the time.time() scale) followed by
+    the uint32 packed message (see RECORD_FORMAT). A SysEx message is recorded
+    as 0xF0 | (length << 8) followed by the message bytes.
+
+    If the @path ends with '.mid' or '.midi', the raw records go to a
+    temporary @path + '.part' file, which is converted to a Standard MIDI File
+    (format 0) when the recorder is closed. The message times are relative to
+    the open() call, with the 1 millisecond resolution. So the memory use
+    doesn't grow during a show, and if the process dies, the recording is
+    still in the .part file (see read_raw()).
+    """
+
+    RECORD_FORMAT = struct.Struct('<dI')
+
+    # 1 tick = 1 ms: 500 ticks per quarter note at 500000 us per quarter note.
+    TICKS_PER_QUARTER = 500
+    TEMPO = 500000
+
+    device_id = -1
+    interface_name = 'file'
+
+    def __init__(self, path):
+        self.path = path
+        self.device_name = path
+        self.is_smf = path.lower().endswith(('.mid', '.midi'))
+        self.raw_path = path + '.part' if self.is_smf else path
+        self.count = 0
+        self._file = None
+        self._start_time = 0.0
+
+    def open(self):
+        self._start_time = time.time()
+        self._file = open(self.raw_path, 'wb')
+
+    def is_open(self):
+        return self._file is not None
+
+    def close(self):
+        self._file.close()
+        self._file = None
+        if self.is_smf:
+            self._write_smf()
+            os.remove(self.raw_path)
+
+    def write(self, packed_msg, timestamp=None):
+        self.write_many((packed_msg,), timestamp)
+
+    def write_many(self, packed_msgs, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        pack = self.RECORD_FORMAT.pack
+        self._file.write(b''.join(pack(timestamp, msg) for msg in packed_msgs))
+        self.count += len(packed_msgs)
+
+    def write_sysex(self, data, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        data = bytes(data)
+        self._file.write(self.RECORD_FORMAT.pack(timestamp, 0xF0 | (len(data) << 8)) + data)
+        self.count += 1
+
+    @staticmethod
+    def read_raw(path):
+        """Read a raw recording: a list of (timestamp, message), where
+        the message is a packed int, or bytes() for a SysEx message."""
+        record = MidiFileRecorder.RECORD_FORMAT
+        with open(path, 'rb') as f:
+            data = f.read()
+        events = []
+        pos = 0
+        while pos + record.size <= len(data):
+            timestamp, msg = record.unpack_from(data, pos)
+            pos += record.size
+            if msg & 0xFF == 0xF0:
+                length = msg >> 8
+                msg = data[pos:pos + length]
+                pos += length
+            events.append((timestamp, msg))
+        return events
+
+    @staticmethod
+    def _var_len(value):
+        """Encode a number as a MIDI variable-length quantity."""
+        result = [value & 0x7F]
+        value >>= 7
+        while value:
+            result.append(0x80 | (value & 0x7F))
+            value >>= 7
+        return bytes(reversed(result))
+
+    def _write_smf(self):
+        track = bytearray()
+        track += b'\x00\xFF\x51\x03' + self.TEMPO.to_bytes(3, 'big')
+        ms_per_tick = self.TEMPO / 1000.0 / self.TICKS_PER_QUARTER
+        prev_tick = 0
+        # The messages may come from several threads, so sort them by time.
+        events = self.read_raw(self.raw_path)
+        for timestamp, msg in sorted(events, key=lambda event: event[0]):
+            tick = max(prev_tick, int(round((timestamp - self._start_time) * 1000 / ms_per_tick)))
+            track += self._var_len(tick - prev_tick)
+            prev_tick = tick
+            if isinstance(msg, bytes):
+                # A SysEx event: 0xF0, the length, the bytes after 0xF0.
+                track += b'\xF0' + self._var_len(len(msg) - 1) + msg[1:]
+                continue
+            status = msg & 0xFF
+            # Program Change and Channel Aftertouch have only one data byte.
+            size = 2 if (status & 0xF0) in (0xC0, 0xD0) else 3
+            track += bytes((status, (msg >> 8) & 0xFF, (msg >> 16) & 0xFF)[:size])
+        track += b'\x00\xFF\x2F\x00'  # End of Track
+
+        with open(self.path, 'wb') as f:
+            f.write(b'MThd' + struct.pack('>IHHH', 6, 0, 1, self.TICKS_PER_QUARTER))
+            f.write(b'MTrk' + struct.pack('>I', len(track)) + track)
@@ -1,7 +1,15 @@
 
 class MidiMsg:
     """The class is only a static helper for generating binary MIDI messages.
-    see: http://www.midi.org/techspecs/midimessages.php"""
+    see: http://www.midi.org/techspecs/midimessages.php
+
+    A message is either a (status, data1, data2) tuple, or the same bytes
+    packed into an integer (the PortMidi PmMessage form):
+        status | (data1 << 8) | (data2 << 16)
+    The packed form is checked once (when it is made), and it is sent as is,
+    so it is the one to use for messages that are built in advance and sent
+    many times (see MidiOutput.write_packed()).
+    """
 
     class Commands:
         NOTE_OFF = 0x80
@@ -18,6 +26,24 @@ class MidiMsg:
         assert (command & 0xF) == 0
         return (command | channel, param1, param2)
 
+    @staticmethod
+    def make_packed(channel, command, param1, param2):
+        return MidiMsg.pack(MidiMsg.make(channel, command, param1, param2))
+
+    @staticmethod
+    def pack(msg_3_bytes_tuple):
+        """Pack a (status, data1, data2) tuple into an integer."""
+        status, data1, data2 = msg_3_bytes_tuple
+        assert 0x80 <= status <= 0xFF
+        assert 0 <= data1 <= 0xFF
+        assert 0 <= data2 <= 0xFF
+        return status | (data1 << 8) | (data2 << 16)
+
+    @staticmethod
+    def unpack(packed_msg):
+        """Unpack an integer into a (status, data1, data2) tuple."""
+        return (packed_msg & 0xFF, (packed_msg >> 8) & 0xFF, (packed_msg >> 16) & 0xFF)
+
 
 class MidiCcMsg:
     """The helper for generating "Control Change" messages.
@@ -63,3 +89,86 @@ class MidiCcMsg:
                             MidiMsg.Commands.CONTROL_CHANGE,
                             controller_num,
                             int_val)
+
+    @staticmethod
+    def make_packed(channel, controller_num, int_val):
+        return MidiMsg.pack(MidiCcMsg.make(channel, controller_num, int_val))
+
+
+class MidiSysExMsg:
+    """The helper for generating "System Exclusive" messages.
+
+    A SysEx message is a bytes() object:
+        0xF0, manufacturer ID (1 or 3 bytes), data (7-bit bytes)..., 0xF7
+    The data format is defined by the device manufacturer.
+    """
+    START = 0xF0
+    END = 0xF7
+
+    # The ID reserved for non-commercial (e.g. our own) devices.
+    NON_COMMERCIAL = 0x7D
+
+    @staticmethod
+    def manufacturer_bytes(manufacturer_id):
+        """1-byte IDs are given as int, 3-byte IDs as a tuple (0x00, b1, b2)."""
+        if isinstance(manufacturer_id, int):
+            manufacturer_id = (manufacturer_id,)
+        assert len(manufacturer_id) in (1, 3)
+        assert all(0 <= b <= 0x7F for b in manufacturer_id)
+        return bytes(manufacturer_id)
+
+    @staticmethod
+    def checksum(data):
+        """The Roland-style checksum: the 7-bit sum of data + checksum is 0."""
+        return (0x80 - sum(data) % 0x80) % 0x80
+
+    @staticmethod
+    def make(manufacturer_id, data):
+        data = bytes(data)
+        assert all(b <= 0x7F for b in data)
+        return (bytes((MidiSysExMsg.START,)) + MidiSysExMsg.manufacturer_bytes(manufacturer_id) +
+                data + bytes((MidiSysExMsg.END,)))
+
+
+class MidiBulkParamsMsg:
+    """A vendor "bulk parameter" SysEx message: a number of consecutive
+    parameters (e.g. all effect values) set at once:
+
+        0xF0, manufacturer ID, device ID, command, address bytes...,
+        values..., [checksum of address and values], 0xF7
+
+    The message layout is built (and checked) once, and make() only puts
+    the values into a preallocated buffer.
+
+    Usage:
+    >>> bulk = MidiBulkParamsMsg(MidiSysExMsg.NON_COMMERCIAL, device_id=0x10,
+    >>>                          command=0x12, address=(0x40, 0x00), size=3)
+    >>> out.write_sysex(bulk.make([64, 0, 127]))
+    """
+
+    def __init__(self, manufacturer_id, device_id, command, address, size, checksum=False):
+        assert 0 <= device_id <= 0x7F
+        assert 0 <= command <= 0x7F
+        address = bytes(address)
+        assert all(b <= 0x7F for b in address)
+
+        self.size = size
+        self.has_checksum = checksum
+        header = (bytes((MidiSysExMsg.START,)) + MidiSysExMsg.manufacturer_bytes(manufacturer_id) +
+                  bytes((device_id, command)) + address)
+        self._values_start = len(header)
+        self._checksum_start = len(header) - len(address)
+        self._buffer = bytearray(header + bytes(size) + bytes(1 if checksum else 0) +
+                                 bytes((MidiSysExMsg.END,)))
+
+    def make(self, values):
+        """Make the message with the given 7-bit values (the size is fixed)."""
+        values = bytes(values)
+        if len(values) != self.size or any(b > 0x7F for b in values):
+            raise ValueError("Expected %d values from 0 to 127, got %r" % (self.size, list(values)))
+        buf = self._buffer
+        start = self._values_start
+        buf[start:start + self.size] = values
+        if self.has_checksum:
+            buf[-2] = MidiSysExMsg.checksum(buf[self._checksum_start:-2])
+        return bytes(buf)
@@ -1,10 +1,9 @@
 """The I/O interface for sending MIDI commands to sound devices.
 
-The module uses the PortMidi library as a backend.
-The PortMidi is a C library, so we use ctypes here to call its functions.
-That implies that the libportmidi (.dll or .so file) must be already installed.
-That also means that we implement our own thing instead of using 'pyportmidi'
-(because of the NIH-syndrome and our desire to use ctypes instead of Cython).
+The messages are sent by a backend. By default, it is the PortMidi library
+(see portmidi.py), other backends don't need any MIDI hardware (see backends.py):
+>>> out = MidiOutput(backend=MemoryBackend())
+>>> out = MidiOutput(backend=MidiFileRecorder('show.mid'))
 
 The entry point is the MidiOutput() class.
 It supports two operations:
@@ -30,145 +29,50 @@ to the one above that uses the 'with' statement:
 >>> out.write((0x80, 65, 127))
 >>> out.close()
 
-As you can see, this is a pretty minimalistic and low-level interface,
-it takes binary MIDI messages as input. We don't define any MidiMsg objects
-here, this is done in higher-level modules.
-"""
-
-import atexit
-import ctypes.util
-from ctypes import c_int, c_int32, c_char_p, c_void_p, POINTER, Structure
-from ctypes import cast, byref
-
-__all__ = ['MidiOutput']
-
-lib_name = ctypes.util.find_library('portmidi')
-libportmidi = ctypes.cdll.LoadLibrary(lib_name)
-
-
-# =============================================================================
-#  typedefs
-# =============================================================================
-
-def _typedef(base_class, new_class_name):
-    """A shortcut for defining new classes with a single line of code."""
-    return type(new_class_name, (base_class,), {})
-
-# typedef enum {...} PmError;
-PmError = _typedef(c_int, 'PmError')
-
-# typedef int PmDeviceID;
-PmDeviceID = _typedef(c_int, 'PmDeviceID')
-
-# typedef void PmStream;
-# Note: we can't actually define "void", so we define a pointer to it.
-PmStreamPtr = _typedef(c_void_p, 'PmStreamPtr')
-
-# typedef int32_t PmTimestamp;
-PmTimestamp = _typedef(c_int32, 'PmTimestamp')
-
-# typedef PmTimestamp (*PmTimeProcPtr)(void *time_info);
-PmTimeProcPtr = ctypes.CFUNCTYPE(PmTimestamp, c_void_p)
-
-
-# typedef struct {
-#     int structVersion; /**< this internal structure version */
-#     const char *interf; /**< underlying MIDI API, e.g. MMSystem or DirectX */
-#     const char *name;   /**< device name, e.g. USB MidiSport 1x1 */
-#     int input; /**< true iff input is available */
-#     int output; /**< true iff output is available */
-#     int opened; /**< used by generic PortMidi code to do error checking on arguments */
-# } PmDeviceInfo;
-class PmDeviceInfo(Structure):
-    _fields_ = [('structVersion', c_int),
-                ('interf', c_char_p),
-                ('name', c_char_p),
-                ('input', c_int),
-                ('output', c_int),
-                ('opened', c_int)]
-
-# A shortcut for "PmDeviceInfo *". There is no such typedef in the libportmidi,
-# we define it here for simplicity, because we always reference it by pointer.
-PmDeviceInfoPtr = POINTER(PmDeviceInfo)
-
-
-# =============================================================================
-#  function imports
-# =============================================================================
-
-class MidiPmError(Exception):
-    pass
+When you send many messages at once (e.g. a bunch of controllers every video
+frame), use write_many(): it sends all of them with a single Pm_Write() call:
+>>> out.write_many([(0xB0, 1, 64), (0xB0, 2, 100), (0xB0, 3, 0)])
 
-# const char *Pm_GetErrorText( PmError errnum )
-Pm_GetErrorText = libportmidi.Pm_GetErrorText
-Pm_GetErrorText.restype = c_char_p
-Pm_GetErrorText.argtypes = (PmError,)
+The tuples are checked and packed into integers on every write. Messages that
+are sent many times can be packed once (see MidiMsg.pack()) and sent with
+write_packed()/write_many_packed(), which take ints (or a numpy uint32 array)
+and pass them to the backend as is:
+>>> packed = [MidiMsg.pack(msg) for msg in ((0xB0, 1, 64), (0xB0, 2, 100))]
+>>> out.write_many_packed(packed)
 
+System Exclusive messages are bytes() from 0xF0 to 0xF7 (see midi/msg.py):
+>>> out.write_sysex(MidiSysExMsg.make(MidiSysExMsg.NON_COMMERCIAL, [1, 2, 3]))
 
-def _check_PmError(err_code, *unused_args):
-    if err_code:
-        raise MidiPmError(Pm_GetErrorText(err_code))
+By default, messages are sent immediately, so any jitter of the caller goes
+straight to the wire. With latency > 0 (in milliseconds), the stream is opened
+with a time source (time.time() based), and the messages are sent at their
+timestamp + latency. So if the timestamps are evenly spaced (e.g. they are
+capture times of video frames), the messages are evenly spaced too:
+>>> with MidiOutput(latency=40) as out:
+>>>    out.write((0xB0, 1, 64), timestamp=frame_capture_time)
 
+As you can see, this is a pretty minimalistic and low-level interface,
+it takes binary MIDI messages as input. We don't define any MidiMsg objects
+here, this is done in higher-level modules.
+"""
 
-def _import(fn_name, restype, *argtypes):
-    fn = getattr(libportmidi, fn_name)
-    fn.restype = restype
-    fn.argtypes = argtypes
-    # Here is a trick: the MidiPmError() is raised automatically when any
-    # imported function returns an eror code.
-    if restype == PmError:
-        fn.errcheck = _check_PmError
-    return fn
-
-# PmError Pm_Initialize( void );
-Pm_Initialize = _import('Pm_Initialize', PmError)
-
-# PmError Pm_Terminate( void );
-Pm_Terminate = _import('Pm_Terminate', PmError)
-
-# int Pm_CountDevices( void );
-Pm_CountDevices = _import('Pm_CountDevices', c_int)
-
-# PmDeviceID Pm_GetDefaultInputDeviceID( void );
-Pm_GetDefaultOutputDeviceID = _import('Pm_GetDefaultOutputDeviceID', PmDeviceID)
-
-# const PmDeviceInfo* Pm_GetDeviceInfo( PmDeviceID id );
-Pm_GetDeviceInfo = _import('Pm_GetDeviceInfo', PmDeviceInfoPtr, PmDeviceID)
-
-# PmError Pm_OpenOutput(
-#     PortMidiStream** stream, PmDeviceID outputDevice, void *outputDriverInfo,
-#     int32_t bufferSize,      PmTimeProcPtr time_proc, void *time_info,
-#     int32_t latency
-# );
-Pm_OpenOutput = _import('Pm_OpenOutput', PmError,
-                        POINTER(PmStreamPtr), PmDeviceID, c_void_p,
-                        c_int32, PmTimeProcPtr, c_void_p,
-                        c_int32)
+import time
 
-# PmError Pm_Close( PortMidiStream* stream );
-Pm_Close = _import('Pm_Close', PmError, PmStreamPtr)
+from midi import portmidi
+from midi.msg import MidiMsg
+from midi.portmidi import PortMidiBackend, MidiPmError, MidiNoOutputException
+from midi.backends import MemoryBackend, MidiFileRecorder
 
-# PmError Pm_WriteShort(PortMidiStream *stream, PmTimestamp when, int32_t msg);
-Pm_WriteShort = _import('Pm_WriteShort', PmError,
-                        PmStreamPtr, PmTimestamp, c_int32)
+__all__ = ['MidiOutput', 'MidiPmError', 'MidiNoOutputException',
+           'PortMidiBackend', 'MemoryBackend', 'MidiFileRecorder']
 
 
 # =============================================================================
 #  MidiOutput implementation
 # =============================================================================
 
-# TODO: check that all MidiOutput are closed when Pm_Terminate is called
-Pm_Initialize()
-atexit.register(Pm_Terminate)
-
-
-class MidiNoOutputException(Exception):
-    pass
-
-
 class MidiOutput:
-    """The interface class for the portmidi's PmStream (the output one)
-    and various related functions: Pm_OpenOutput/Pm_WriteShort/Pm_Close/etc.
+    """The interface class for sending messages to a MIDI output.
 
     Usage:
     with MidiOutput() as o:
@@ -177,28 +81,22 @@ class MidiOutput:
         o.write((0x90, 67, 127))
         sleep(1)
         o.write((0xB0, 0x7B, 0))  # AllNotesOff
-    """
 
-    def __init__(self, device_id=None):
-        if device_id is None:
-            device_id = Pm_GetDefaultOutputDeviceID().value
-        self.device_id = device_id
+    With debug=True, every sent message is printed.
 
-        # Fetch strings from the PmDeviceInfo structure.
-        device_info = Pm_GetDeviceInfo(device_id).contents
-        self.device_name = device_info.name
-        self.interface_name = device_info.interf
-
-        # In Python3, char_p fields are bytes() (not str() as in Python2),
-        # so we have to decode() them manually.
-        if isinstance(self.device_name, bytes):
-            self.device_name = self.device_name.decode('utf-8')
-            self.interface_name = self.interface_name.decode('utf-8')
+    The @device_id, @latency and @buffer_size are the PortMidiBackend
+    arguments. Another @backend can be passed instead.
+    """
 
-        # Ban devices that don't support MIDI output.
-        if not device_info.output:
-            msg = "Can't create MidiOutput() on a non-output device: %s" % self
-            raise MidiNoOutputException(msg)
+    def __init__(self, device_id=None, debug=False, latency=0, buffer_size=None,
+                 backend=None):
+        if backend is None:
+            backend = PortMidiBackend(device_id, latency, buffer_size)
+        self.backend = backend
+        self.debug = debug
+        self.device_id = backend.device_id
+        self.device_name = backend.device_name
+        self.interface_name = backend.interface_name
 
     def __enter__(self):
         self.open()
@@ -208,7 +106,8 @@ class MidiOutput:
         self.close()
 
     def __del__(self):
-        if (self.is_open()):
+        # The backend is missing if the constructor failed.
+        if hasattr(self, 'backend') and self.is_open():
             self.close()
 
     def __str__(self):
@@ -220,66 +119,99 @@ class MidiOutput:
                 self.device_id, self.device_name, self.interface_name))
 
     def open(self):
-        # The libportmidi allocates a PortMidiStream strcuture and sets our
-        # pointer to this strucutre. We pass a reference to this pointer as an
-        # argument.
-        stream_ptr = PmStreamPtr()
-        device_id = PmDeviceID(self.device_id)
-
-        # No buffering/timing at all.
-        drv_info = c_void_p(None)
-        buf_size = c_int32(0)
-        time_proc = cast(None, PmTimeProcPtr)
-        time_info = c_void_p(None)
-        latency = c_int32(0)
-
-        Pm_OpenOutput(byref(stream_ptr), device_id,
-                      drv_info, buf_size, time_proc, time_info, latency)
-        self.stream_ptr = stream_ptr
+        self.backend.open()
 
     def is_open(self):
-        return hasattr(self, 'stream_ptr')
+        return self.backend.is_open()
 
     def close(self):
-        Pm_Close(self.stream_ptr)
-        del self.stream_ptr
-
-    # TODO: support writing more than 3-byte messages (SysEx, etc).
-    def write(self, msg_3_bytes_tuple):
-        status, data1, data2 = msg_3_bytes_tuple
-        assert 0 <= status <= 0xFF
-        assert 0 <= data1 <= 0xFF
-        assert 0 <= data2 <= 0xFF
-        data1 <<= 8
-        data2 <<= 16
-
-        midi_msg = c_int32(status | data1 | data2)
-        timestamp = PmTimestamp(0)
-
-        print("send midi message: %s" % str(msg_3_bytes_tuple))
-        Pm_WriteShort(self.stream_ptr, timestamp, midi_msg)
+        self.backend.close()
+
+    def write(self, msg_3_bytes_tuple, timestamp=None):
+        if self.debug:
+            print("send midi message: %s" % str(msg_3_bytes_tuple))
+        self.backend.write(MidiMsg.pack(msg_3_bytes_tuple), timestamp)
+
+    def write_many(self, msg_tuples, timestamp=None):
+        """Send a list of 3-byte messages at once (e.g. with a single Pm_Write()).
+
+        All of them get the same @timestamp.
+        """
+        if self.debug:
+            print("send midi messages: %s" % str(msg_tuples))
+        self.backend.write_many([MidiMsg.pack(msg) for msg in msg_tuples], timestamp)
+
+    def write_packed(self, packed_msg, timestamp=None):
+        """Send a message packed into an integer (see MidiMsg.pack()).
+
+        It is not checked here, it must be checked when it is packed.
+        """
+        if self.debug:
+            print("send midi message: %s" % str(MidiMsg.unpack(packed_msg)))
+        self.backend.write(packed_msg, timestamp)
+
+    def write_many_packed(self, packed_msgs, timestamp=None):
+        """Send a list of packed messages (or a numpy uint32 array) at once."""
+        if self.debug:
+            print("send midi messages: %s" % str([MidiMsg.unpack(int(msg)) for msg in packed_msgs]))
+        self.backend.write_many(packed_msgs, timestamp)
+
+    def write_sysex(self, data, timestamp=None):
+        """Send a SysEx message: bytes from 0xF0 to 0xF7 (see MidiSysExMsg)."""
+        assert data[0] == 0xF0 and data[-1] == 0xF7
+        if self.debug:
+            print("send midi sysex: %s" % bytes(data).hex())
+        self.backend.write_sysex(data, timestamp)
 
     @staticmethod
-    def discover():
-        """Get a list of all available MIDI outputs (as MidiOutput objects)."""
-        found_outputs = []
-        device_count = Pm_CountDevices()
-        for device_id in range(device_count):
-            try:
-                found_outputs.append(MidiOutput(device_id))
-            except MidiNoOutputException:
-                pass
-        return found_outputs
+    def discover(refresh=False):
+        """Get a list of all available MIDI outputs (as MidiOutput objects).
+
+        The device list is read once and cached, use refresh=True to find
+        devices that were plugged in after that.
+        """
+        if refresh:
+            portmidi.refresh_devices()
+        return [MidiOutput(device.device_id)
+                for device in portmidi.devices() if device.is_output]
 
 
 # =============================================================================
 #  test/demo
 # =============================================================================
-# When the file is executed, try to discover all available MIDI outputs,
-# and play a short demo (a couple of notes and a chord) to each output.
+# When the file is executed, measure the cost of a message sent as a tuple and
+# pre-packed (to a MemoryBackend), then try to discover all available MIDI
+# outputs, and play a short demo (a couple of notes and a chord) to each output.
 
 if __name__ == '__main__':
+    import timeit
     from time import sleep
+
+    import numpy as np
+
+    from midi.msg import MidiCcMsg
+
+    N = 32
+    out = MidiOutput(backend=MemoryBackend())
+    out.open()
+    msg_tuples = [MidiCcMsg.make(0, n, 64) for n in range(N)]
+    packed = [MidiMsg.pack(msg) for msg in msg_tuples]
+    packed_array = np.array(packed, np.uint32)
+    cases = [
+        ("make + write (tuple)", lambda: [out.write(MidiCcMsg.make(0, n, 64)) for n in range(N)]),
+        ("write (tuple)", lambda: [out.write(msg) for msg in msg_tuples]),
+        ("write_packed (int)", lambda: [out.write_packed(msg) for msg in packed]),
+        ("write_many (tuples)", lambda: out.write_many(msg_tuples)),
+        ("write_many_packed (ints)", lambda: out.write_many_packed(packed)),
+        ("write_many_packed (uint32 array)", lambda: out.write_many_packed(packed_array)),
+    ]
+    for name, fn in cases:
+        t = min(timeit.repeat(fn, number=1000, repeat=3)) / 1000
+        print("{:>34}: {:1.3f} us per message".format(name, t / N * 1e6))
+    _, recent = out.backend.recent(N)
+    assert recent.tolist() == packed
+    out.close()
+
     for output in MidiOutput.discover():
         print("playing few notes to: %s" % output)
         with output as o:
@@ -296,3 +228,13 @@ if __name__ == '__main__':
             o.write((0x90, 67, 127))
             sleep(1)
             o.write((0xB0, 0x7B, 0))
+
+        print("playing a scheduled arpeggio to: %s" % output)
+        with MidiOutput(output.device_id, latency=100) as o:
+            # All the notes are written at once, and PortMidi plays them
+            # at their timestamps (+100 ms of latency).
+            now = time.time()
+            for n, note in enumerate((60, 64, 67, 72, 67, 64, 60)):
+                o.write((0x90, note, 127), timestamp=now + n * 0.15)
+                o.write((0x80, note, 127), timestamp=now + n * 0.15 + 0.1)
+            sleep(1.5)
@@ -0,0 +1,387 @@
+"""The PortMidi backend of the MidiOutput (see output.py).
+
+The PortMidi is a C library, so we use ctypes here to call its functions.
+That implies that the libportmidi (.dll or .so file) must be already installed.
+That also means that we implement our own thing instead of using 'pyportmidi'
+(because of the NIH-syndrome and our desire to use ctypes instead of Cython).
+"""
+
+import atexit
+import time
+import ctypes.util
+from ctypes import c_int, c_int32, c_char_p, c_void_p, c_ubyte, POINTER, Structure
+from ctypes import cast, byref, memmove
+
+import numpy as np
+
+__all__ = ['PortMidiBackend', 'PortMidiDevice', 'MidiPmError', 'MidiNoOutputException',
+           'devices', 'refresh_devices']
+
+# The library is loaded (and initialized) on the first use, see _load().
+libportmidi = None
+
+# =============================================================================
+#  typedefs
+# =============================================================================
+
+def _typedef(base_class, new_class_name):
+    """A shortcut for defining new classes with a single line of code."""
+    return type(new_class_name, (base_class,), {})
+
+# typedef enum {...} PmError;
+PmError = _typedef(c_int, 'PmError')
+
+# typedef int PmDeviceID;
+PmDeviceID = _typedef(c_int, 'PmDeviceID')
+
+# typedef void PmStream;
+# Note: we can't actually define "void", so we define a pointer to it.
+PmStreamPtr = _typedef(c_void_p, 'PmStreamPtr')
+
+# typedef int32_t PmTimestamp;
+PmTimestamp = _typedef(c_int32, 'PmTimestamp')
+
+# typedef PmTimestamp (*PmTimeProcPtr)(void *time_info);
+PmTimeProcPtr = ctypes.CFUNCTYPE(PmTimestamp, c_void_p)
+
+# typedef int32_t PmMessage;
+PmMessage = _typedef(c_int32, 'PmMessage')
+
+
+# typedef struct {
+#     PmMessage      message;
+#     PmTimestamp    timestamp;
+# } PmEvent;
+class PmEvent(Structure):
+    _fields_ = [('message', PmMessage),
+                ('timestamp', PmTimestamp)]
+
+
+# typedef struct {
+#     int structVersion; /**< this internal structure version */
+#     const char *interf; /**< underlying MIDI API, e.g. MMSystem or DirectX */
+#     const char *name;   /**< device name, e.g. USB MidiSport 1x1 */
+#     int input; /**< true iff input is available */
+#     int output; /**< true iff output is available */
+#     int opened; /**< used by generic PortMidi code to do error checking on arguments */
+# } PmDeviceInfo;
+class PmDeviceInfo(Structure):
+    _fields_ = [('structVersion', c_int),
+                ('interf', c_char_p),
+                ('name', c_char_p),
+                ('input', c_int),
+                ('output', c_int),
+                ('opened', c_int)]
+
+# A shortcut for "PmDeviceInfo *". There is no such typedef in the libportmidi,
+# we define it here for simplicity, because we always reference it by pointer.
+PmDeviceInfoPtr = POINTER(PmDeviceInfo)
+
+
+# =============================================================================
+#  function imports
+# =============================================================================
+
+class MidiPmError(Exception):
+    pass
+
+
+def _check_PmError(err_code, *unused_args):
+    if err_code:
+        raise MidiPmError(Pm_GetErrorText(err_code))
+
+
+def _import(fn_name, restype, *argtypes):
+    fn = getattr(libportmidi, fn_name)
+    fn.restype = restype
+    fn.argtypes = argtypes
+    # Here is a trick: the MidiPmError() is raised automatically when any
+    # imported function returns an eror code.
+    if restype == PmError:
+        fn.errcheck = _check_PmError
+    return fn
+
+
+def _load():
+    """Load the libportmidi, import its functions and initialize it.
+
+    It is done on the first use (not on the module import), so the modules
+    that use MidiOutput can be imported (and used with other backends)
+    without the PortMidi installed.
+    """
+    global libportmidi, Pm_GetErrorText, Pm_Initialize, Pm_Terminate
+    global Pm_CountDevices, Pm_GetDefaultOutputDeviceID, Pm_GetDeviceInfo
+    global Pm_OpenOutput, Pm_Close, Pm_WriteShort, Pm_Write, Pm_WriteSysEx
+    if libportmidi is not None:
+        return
+
+    lib_name = ctypes.util.find_library('portmidi')
+    if lib_name is None:
+        raise MidiPmError("The PortMidi library (libportmidi) is not found")
+    libportmidi = ctypes.cdll.LoadLibrary(lib_name)
+
+    # const char *Pm_GetErrorText( PmError errnum )
+    Pm_GetErrorText = libportmidi.Pm_GetErrorText
+    Pm_GetErrorText.restype = c_char_p
+    Pm_GetErrorText.argtypes = (PmError,)
+
+    # PmError Pm_Initialize( void );
+    Pm_Initialize = _import('Pm_Initialize', PmError)
+
+    # PmError Pm_Terminate( void );
+    Pm_Terminate = _import('Pm_Terminate', PmError)
+
+    # int Pm_CountDevices( void );
+    Pm_CountDevices = _import('Pm_CountDevices', c_int)
+
+    # PmDeviceID Pm_GetDefaultInputDeviceID( void );
+    Pm_GetDefaultOutputDeviceID = _import('Pm_GetDefaultOutputDeviceID', PmDeviceID)
+
+    # const PmDeviceInfo* Pm_GetDeviceInfo( PmDeviceID id );
+    Pm_GetDeviceInfo = _import('Pm_GetDeviceInfo', PmDeviceInfoPtr, PmDeviceID)
+
+    # PmError Pm_OpenOutput(
+    #     PortMidiStream** stream, PmDeviceID outputDevice, void *outputDriverInfo,
+    #     int32_t bufferSize,      PmTimeProcPtr time_proc, void *time_info,
+    #     int32_t latency
+    # );
+    Pm_OpenOutput = _import('Pm_OpenOutput', PmError,
+                            POINTER(PmStreamPtr), PmDeviceID, c_void_p,
+                            c_int32, PmTimeProcPtr, c_void_p,
+                            c_int32)
+
+    # PmError Pm_Close( PortMidiStream* stream );
+    Pm_Close = _import('Pm_Close', PmError, PmStreamPtr)
+
+    # PmError Pm_WriteShort(PortMidiStream *stream, PmTimestamp when, int32_t msg);
+    Pm_WriteShort = _import('Pm_WriteShort', PmError,
+                            PmStreamPtr, PmTimestamp, c_int32)
+
+    # PmError Pm_Write(PortMidiStream *stream, PmEvent *buffer, int32_t length);
+    Pm_Write = _import('Pm_Write', PmError,
+                       PmStreamPtr, POINTER(PmEvent), c_int32)
+
+    # PmError Pm_WriteSysEx(PortMidiStream *stream, PmTimestamp when, unsigned char *msg);
+    Pm_WriteSysEx = _import('Pm_WriteSysEx', PmError,
+                            PmStreamPtr, PmTimestamp, POINTER(c_ubyte))
+
+    # TODO: check that all MidiOutput are closed when Pm_Terminate is called
+    Pm_Initialize()
+    atexit.register(Pm_Terminate)
+
+
+# =============================================================================
+#  device table
+# =============================================================================
+# PortMidi lists the devices only once, in Pm_Initialize(). We read the list
+# once too, and keep it here, so the discovery costs nothing after that.
+
+class PortMidiDevice:
+    """A row of the device table (the PmDeviceInfo fields we need)."""
+
+    def __init__(self, device_id, interface_name, device_name, is_input, is_output):
+        self.device_id = device_id
+        self.interface_name = interface_name
+        self.device_name = device_name
+        self.is_input = is_input
+        self.is_output = is_output
+
+
+_devices = None
+_default_output_id = None
+_open_streams = 0
+
+
+def _read_devices():
+    global _devices, _default_output_id
+    devices = []
+    for device_id in range(Pm_CountDevices()):
+        info = Pm_GetDeviceInfo(device_id).contents
+        # In Python3, char_p fields are bytes() (not str() as in Python2),
+        # so we have to decode() them manually.
+        interface_name = info.interf
+        device_name = info.name
+        if isinstance(device_name, bytes):
+            device_name = device_name.decode('utf-8')
+            interface_name = interface_name.decode('utf-8')
+        devices.append(PortMidiDevice(device_id, interface_name, device_name,
+                                      bool(info.input), bool(info.output)))
+    _devices = devices
+    _default_output_id = Pm_GetDefaultOutputDeviceID().value
+
+
+def devices():
+    """Get the (cached) list of all MIDI devices (PortMidiDevice objects)."""
+    _load()
+    if _devices is None:
+        _read_devices()
+    return _devices
+
+
+def default_output_id():
+    devices()
+    return _default_output_id
+
+
+def refresh_devices():
+    """Read the device list again, e.g. after a device was plugged in.
+
+    PortMidi finds new devices only when it is initialized, so it is
+    re-initialized, but only when no streams are open (otherwise the old
+    list is kept, and False is returned).
+    """
+    _load()
+    if _open_streams:
+        return False
+    Pm_Terminate()
+    Pm_Initialize()
+    _read_devices()
+    return True
+
+
+class MidiNoOutputException(Exception):
+    pass
+
+
+class PortMidiBackend:
+    """The portmidi's PmStream (the output one) and the related functions:
+    Pm_OpenOutput/Pm_Write/Pm_Close/etc.
+
+    With latency > 0 (in milliseconds), the messages are buffered by PortMidi
+    (up to @buffer_size messages) and sent at their timestamps + latency.
+    The timestamps are in the time.time() scale.
+    """
+
+    # The number of PmEvent structures preallocated for write_many().
+    # Longer lists of messages are sent in several Pm_Write() calls.
+    EVENT_BUFFER_SIZE = 64
+
+    # The initial size of the SysEx buffer (it grows for longer messages).
+    SYSEX_BUFFER_SIZE = 256
+
+    # The PortMidi output buffer size (in messages) for the latency mode.
+    OUTPUT_BUFFER_SIZE = 256
+
+    def __init__(self, device_id=None, latency=0, buffer_size=None):
+        if device_id is None:
+            device_id = default_output_id()
+        self.device_id = device_id
+        self.latency = latency
+        if buffer_size is None:
+            buffer_size = self.OUTPUT_BUFFER_SIZE if latency else 0
+        self.buffer_size = buffer_size
+        self._events = (PmEvent * self.EVENT_BUFFER_SIZE)()
+        # The same memory as a numpy array with 'message' and 'timestamp' fields.
+        self._event_array = np.ctypeslib.as_array(self._events)
+        self._sysex = (c_ubyte * self.SYSEX_BUFFER_SIZE)()
+        self._epoch = time.time()
+        # Keep a reference to the callback, otherwise it is garbage-collected
+        # while PortMidi still calls it.
+        self._time_proc = PmTimeProcPtr(self._pm_time)
+
+        all_devices = devices()
+        if not 0 <= device_id < len(all_devices):
+            raise MidiNoOutputException("There is no MIDI device #%d" % device_id)
+        device = all_devices[device_id]
+        self.device_name = device.device_name
+        self.interface_name = device.interface_name
+
+        # Ban devices that don't support MIDI output.
+        if not device.is_output:
+            msg = ("Can't create MidiOutput() on a non-output device #%d: %s - %s" %
+                   (device_id, self.interface_name, self.device_name))
+            raise MidiNoOutputException(msg)
+
+    def open(self):
+        # The libportmidi allocates a PortMidiStream strcuture and sets our
+        # pointer to this strucutre. We pass a reference to this pointer as an
+        # argument.
+        stream_ptr = PmStreamPtr()
+        device_id = PmDeviceID(self.device_id)
+
+        drv_info = c_void_p(None)
+        buf_size = c_int32(self.buffer_size)
+        time_info = c_void_p(None)
+        latency = c_int32(self.latency)
+        if self.latency:
+            # PortMidi calls the time_proc to find out when to send messages.
+            self._epoch = time.time()
+            time_proc = self._time_proc
+        else:
+            # No buffering/timing at all.
+            time_proc = cast(None, PmTimeProcPtr)
+
+        global _open_streams
+        Pm_OpenOutput(byref(stream_ptr), device_id,
+                      drv_info, buf_size, time_proc, time_info, latency)
+        self.stream_ptr = stream_ptr
+        _open_streams += 1
+
+    def is_open(self):
+        return hasattr(self, 'stream_ptr')
+
+    def close(self):
+        global _open_streams
+        Pm_Close(self.stream_ptr)
+        del self.stream_ptr
+        _open_streams -= 1
+
+    def _pm_time(self, unused_time_info):
+        """The PortMidi time source: milliseconds since the stream opening."""
+        return int((time.time() - self._epoch) * 1000)
+
+    def _to_pm_time(self, timestamp):
+        """Convert a time.time() timestamp (None means "now") to a PmTimestamp.
+
+        With latency, "now" is the current stream time, not 0: PortMidi sends
+        the messages with the timestamp 0 immediately, so they would overtake
+        the earlier messages that are still waiting for their time.
+        """
+        if not self.latency:
+            return 0
+        if timestamp is None:
+            return self._pm_time(None)
+        return max(0, int((timestamp - self._epoch) * 1000))
+
+    def write(self, packed_msg, timestamp=None):
+        Pm_WriteShort(self.stream_ptr, PmTimestamp(self._to_pm_time(timestamp)),
+                      c_int32(packed_msg))
+
+    def write_many(self, packed_msgs, timestamp=None):
+        """Send messages with a single Pm_Write() call.
+
+        The messages are put into a preallocated PmEvent array,
+        so no ctypes objects are created per message.
+        A numpy array of messages is copied there without a Python loop.
+        """
+        events = self._events
+        pm_time = self._to_pm_time(timestamp)
+        if isinstance(packed_msgs, np.ndarray):
+            event_array = self._event_array
+            for start in range(0, len(packed_msgs), self.EVENT_BUFFER_SIZE):
+                chunk = packed_msgs[start:start + self.EVENT_BUFFER_SIZE]
+                event_array['message'][:len(chunk)] = chunk
+                event_array['timestamp'][:len(chunk)] = pm_time
+                Pm_Write(self.stream_ptr, events, len(chunk))
+            return
+        n = 0
+        for msg in packed_msgs:
+            events[n].message = msg
+            events[n].timestamp = pm_time
+            n += 1
+            if n == self.EVENT_BUFFER_SIZE:
+                Pm_Write(self.stream_ptr, events, n)
+                n = 0
+        if n:
+            Pm_Write(self.stream_ptr, events, n)
+
+    def write_sysex(self, data, timestamp=None):
+        """Send a SysEx message (bytes from 0xF0 to 0xF7) with Pm_WriteSysEx().
+
+        The message is copied into a preallocated buffer (so no ctypes objects
+        are created per message).
+        """
+        if len(data) > len(self._sysex):
+            self._sysex = (c_ubyte * (len(data) * 2))()
+        memmove(self._sysex, bytes(data), len(data))
+        Pm_WriteSysEx(self.stream_ptr, PmTimestamp(self._to_pm_time(timestamp)), self._sysex)
@@ -0,0 +1,310 @@
+"""Asynchronous MIDI output: messages are sent on background threads.
+
+MidiOutput.write() blocks until the driver accepts the message, so a slow or
+stalled (USB) MIDI device stalls the caller, i.e. the frame processing loop.
+
+The MidiSender() wraps a MidiOutput: write()/write_many() only put messages
+into a bounded queue and return immediately, and a sender thread drains the
+queue into the MidiOutput. The queue keeps only the latest value of each
+controller (a newer Control Change message replaces the queued one for the
+same channel/controller), and when the queue is full, the oldest message is
+dropped. So a stalled device never makes the queue grow, and when it comes
+back, it gets the latest values.
+
+The messages are queued packed into integers (see MidiMsg.pack()): tuples
+are packed by write()/write_many(), and pre-packed messages can be queued with
+write_packed()/write_many_packed() as is.
+
+The MidiFanOut() sends the same messages to several senders (devices).
+
+Usage:
+>>> sender = MidiSender(MidiOutput(1))
+>>> sender.start()
+>>> sender.write_many([(0xB0, 1, 64), (0xB0, 2, 100)])
+>>> print(sender.stats())
+>>> sender.stop()
+"""
+
+import collections
+import itertools
+import threading
+import time
+
+import numpy as np
+
+from midi.msg import MidiMsg
+
+__all__ = ['MidiSender', 'MidiFanOut']
+
+SENDER_QUEUE_SIZE = 64
+
+
+class MidiSender:
+    """Sends messages to a MidiOutput (which must be open) on its own thread.
+
+    It has the same write*() methods as the MidiOutput, so it can be used
+    in place of it. The output must have write_many_packed() and write_sysex().
+
+    Counters:
+        sent      - messages written to the output
+        coalesced - messages replaced by a newer value before they were sent
+        dropped   - messages dropped because the queue was full
+        max_depth - the maximum number of queued messages
+        last_latency/max_latency - the time (in seconds) between queueing
+                                   and writing messages to the output
+    """
+
+    def __init__(self, midi_out, max_size=SENDER_QUEUE_SIZE):
+        self.midi_out = midi_out
+        self.max_size = max_size
+
+        self._cond = threading.Condition()
+        # key -> (msg, timestamp, queued_time)
+        self._queue = collections.OrderedDict()
+        self._seq = 0
+        self._running = False
+        self._thread = None
+
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+
+    @property
+    def depth(self):
+        """The number of messages in the queue."""
+        return len(self._queue)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='MidiSender')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Send the queued messages and stop the thread."""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _key(self, packed_msg):
+        # Only the last value of a controller matters: the key of a CC message
+        # is its status and controller number (the lower 16 bits). Other
+        # messages (e.g. notes) are never replaced, so they get unique keys
+        # (negative, so they never match a CC key).
+        if packed_msg & 0xF0 == MidiMsg.Commands.CONTROL_CHANGE:
+            return packed_msg & 0xFFFF
+        self._seq += 1
+        return -self._seq
+
+    def _keys(self, packed_msgs):
+        """_key() of every message of a numpy array (computed by numpy)."""
+        is_cc = (packed_msgs & 0xF0) == MidiMsg.Commands.CONTROL_CHANGE
+        if is_cc.all():
+            return (packed_msgs & 0xFFFF).tolist()
+        seqs = self._seq + np.cumsum(~is_cc)
+        if len(seqs):
+            self._seq = int(seqs[-1])
+        return np.where(is_cc, packed_msgs & 0xFFFF, -seqs).tolist()
+
+    def _put(self, key, msg, timestamp, now):
+        """Put a message into the queue (call it with the lock held)."""
+        queue = self._queue
+        if key in queue:
+            self.coalesced += 1
+        elif len(queue) >= self.max_size:
+            queue.popitem(last=False)
+            self.dropped += 1
+        queue[key] = (msg, timestamp, now)
+
+    def _put_many(self, keys, msgs, timestamp, now):
+        """Put messages into the queue at once (call it with the lock held).
+
+        The result is the same as of _put() for every message, but the
+        queue is updated (and the counters are computed) without a Python loop.
+        """
+        queue = self._queue
+        size = len(queue)
+        queue.update(zip(keys, zip(msgs, itertools.repeat(timestamp), itertools.repeat(now))))
+        self.coalesced += len(keys) - (len(queue) - size)
+        while len(queue) > self.max_size:
+            queue.popitem(last=False)
+            self.dropped += 1
+
+    def write(self, msg, timestamp=None):
+        self.write_many((msg,), timestamp)
+
+    def write_many(self, msgs, timestamp=None):
+        self.write_many_packed([MidiMsg.pack(msg) for msg in msgs], timestamp)
+
+    def write_packed(self, packed_msg, timestamp=None):
+        self.write_many_packed((packed_msg,), timestamp)
+
+    def write_many_packed(self, packed_msgs, timestamp=None):
+        """Queue packed messages (a list of ints or a numpy uint32 array)."""
+        now = time.time()
+        with self._cond:
+            if isinstance(packed_msgs, np.ndarray):
+                keys = self._keys(packed_msgs)
+                packed_msgs = packed_msgs.tolist()
+            else:
+                keys = [self._key(msg) for msg in packed_msgs]
+            self._put_many(keys, packed_msgs, timestamp, now)
+            self.max_depth = max(self.max_depth, len(self._queue))
+            self._cond.notify()
+
+    def write_sysex(self, data, timestamp=None, replace_key=None):
+        """Queue a SysEx message.
+
+        Messages with the same @replace_key (e.g. dumps of the whole state)
+        replace each other in the queue, like the CC values do.
+        """
+        now = time.time()
+        with self._cond:
+            if replace_key is None:
+                # Negative, like the keys of other non-CC messages (see _key()).
+                self._seq += 1
+                key = -self._seq
+            else:
+                key = ('sysex', replace_key)
+            self._put(key, bytes(data), timestamp, now)
+            self.max_depth = max(self.max_depth, len(self._queue))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue or not self._running)
+                if not self._queue:
+                    break
+                items = list(self._queue.values())
+                self._queue.clear()
+
+            # Short messages with the same timestamp are sent in one write.
+            start = 0
+            while start < len(items):
+                msg, timestamp = items[start][:2]
+                if isinstance(msg, bytes):
+                    self.midi_out.write_sysex(msg, timestamp)
+                    start += 1
+                    continue
+                end = start + 1
+                while (end < len(items) and items[end][1] == timestamp and
+                       not isinstance(items[end][0], bytes)):
+                    end += 1
+                self.midi_out.write_many_packed([item[0] for item in items[start:end]], timestamp)
+                start = end
+
+            self.sent += len(items)
+            self.last_latency = time.time() - min(item[2] for item in items)
+            self.max_latency = max(self.max_latency, self.last_latency)
+
+    def stats(self):
+        return ("queue: {} (max {}), sent: {}, coalesced: {}, dropped: {}, "
+                "latency: {:1.1f} ms (max {:1.1f} ms)".format(
+                    self.depth, self.max_depth, self.sent, self.coalesced, self.dropped,
+                    self.last_latency * 1000, self.max_latency * 1000))
+
+
+class MidiFanOut:
+    """Sends the same messages to several outputs (e.g. MidiSender objects)."""
+
+    def __init__(self, outputs):
+        self.outputs = list(outputs)
+
+    def write(self, msg, timestamp=None):
+        for out in self.outputs:
+            out.write(msg, timestamp)
+
+    def write_many(self, msgs, timestamp=None):
+        for out in self.outputs:
+            out.write_many(msgs, timestamp)
+
+    def write_packed(self, packed_msg, timestamp=None):
+        for out in self.outputs:
+            out.write_packed(packed_msg, timestamp)
+
+    def write_many_packed(self, packed_msgs, timestamp=None):
+        for out in self.outputs:
+            out.write_many_packed(packed_msgs, timestamp)
+
+    def write_sysex(self, data, timestamp=None, **kwargs):
+        for out in self.outputs:
+            out.write_sysex(data, timestamp, **kwargs)
+
+
+# =============================================================================
+#  test/demo
+# =============================================================================
+# When the file is executed, send messages to a slow fake output, and check
+# that the caller is not blocked and the queue keeps only the latest values.
+# Run it from the src directory as: python -m midi.sender
+
+if __name__ == '__main__':
+
+    class SlowOutput:
+        def __init__(self):
+            self.received = []
+
+        def write_many_packed(self, packed_msgs, timestamp=None):
+            time.sleep(0.05)  # a stalled USB device
+            self.received.extend(MidiMsg.unpack(msg) for msg in packed_msgs)
+
+    out = SlowOutput()
+    sender = MidiSender(out, max_size=8)
+    sender.start()
+
+    start = time.time()
+    for n in range(100):
+        sender.write_many([(0xB0, 1, n), (0xB1, 2, n)])
+    print("100 writes took %1.2f ms" % ((time.time() - start) * 1000))
+    sender.stop()
+
+    print(sender.stats())
+    assert sender.sent + sender.coalesced + sender.dropped == 200
+    assert out.received[-2:] == [(0xB0, 1, 99), (0xB1, 2, 99)]
+
+    # SysEx messages must never replace queued CC messages.
+    out = SlowOutput()
+    out.sysex = []
+    out.write_sysex = lambda data, timestamp=None: out.sysex.append(data)
+    sender = MidiSender(out, max_size=1000)
+    # (0xB0 = 176 is the key of the CC, and the SysEx is the 176th non-CC message.)
+    for n in range(175):
+        sender.write((0x90, n % 128, 100))
+    sender.write((0xB0, 0, 64))
+    sender.write_sysex(b'\xF0\x7D\x01\xF7')
+    assert sender.coalesced == 0
+    sender.start()
+    sender.stop()
+    assert (0xB0, 0, 64) in out.received and len(out.sysex) == 1
+
+    # A numpy array is queued like the same list of messages (its keys are
+    # computed by numpy), and faster.
+    import timeit
+
+    rng = np.random.RandomState(0)
+    msgs = [MidiMsg.pack((status, data1, rng.randint(128)))
+            for status, data1 in zip(rng.choice([0x90, 0xB0, 0xB1], 500), rng.randint(0, 8, 500))]
+    from_list = MidiSender(out, max_size=16)
+    from_array = MidiSender(out, max_size=16)
+    for start in range(0, len(msgs), 50):
+        from_list.write_many_packed(msgs[start:start + 50])
+        from_array.write_many_packed(np.array(msgs[start:start + 50], np.uint32))
+    assert [item[0] for item in from_list._queue.values()] == \
+        [item[0] for item in from_array._queue.values()]
+    assert (from_list.coalesced, from_list.dropped) == (from_array.coalesced, from_array.dropped)
+
+    for n_msgs in (32, 512):
+        cc_msgs = [MidiMsg.pack((0xB0 | (n >> 7), n & 0x7F, 64)) for n in range(n_msgs)]
+        cc_array = np.array(cc_msgs, np.uint32)
+        sender = MidiSender(out, max_size=n_msgs)
+        for name, msgs in (("list", cc_msgs), ("uint32 array", cc_array)):
+            t = min(timeit.repeat(lambda: sender.write_many_packed(msgs), number=200, repeat=3)) / 200
+            print("write_many_packed ({} messages, {}): {:1.3f} us per message".format(
+                n_msgs, name, t / n_msgs * 1e6))
@@ -0,0 +1,211 @@
+"""A configurable modulation graph: tracker features -> filters -> controllers.
+
+The FxModulator drives three hardcoded effects (A, B, C). The ModGraph drives
+any number of controllers, described in a config file (see modgraph.json):
+
+{
+    "regions": {                              (optional, "all" is predefined)
+        "left": [0.0, 0.0, 0.5, 1.0],         x0, y0, x1, y1 (fractions of the frame)
+        ...
+    },
+    "outputs": [
+        {
+            "name": "A",
+            "feature": "coherence",           one of FEATURES (see below)
+            "region": "all",                  only tracks inside the region are used
+            "gain": 1.0, "offset": 0.0,       value = feature * gain + offset (clipped to 0..1)
+            "attack": 4.0, "decay": 10.0,     exponential filter time constants (in seconds,
+                                              0 - no filtering)
+            "channel": 7, "controller": 0,    the MIDI CC of the output
+            "default": 0.5,                   (optional) the MidiCcFx default value
+            "curve": "log"                    (optional) the MidiCcFx response curve:
+                                              a name or [[x, y], ...] breakpoints
+        },
+        ...
+    ]
+}
+
+Features of the tracks inside a region (significant tracks are the ones that
+move fast enough, see tracks.SPEED_THRESHOLD):
+    coherence  - 0..1, how much the significant tracks move in one direction
+    density    - the number of tracks
+    activity   - 0..1, the fraction of significant tracks
+    mean_speed - the mean speed of significant tracks (pixels per second)
+    flow_x     - -1..1, the horizontal component of the coherent motion
+    flow_y     - -1..1, the vertical component of the coherent motion
+    center_x   - 0..1, the mean horizontal position of tracks
+    center_y   - 0..1, the mean vertical position of tracks
+
+The config is compiled into arrays (one element per output), so all outputs
+are updated by a few numpy operations per frame, regardless of their number:
+features are computed once for every region, gathered for every output,
+scaled and filtered at once.
+
+Usage:
+>>> graph = ModGraph.load('modgraph.json', width, height)
+>>> fx_changer = FxChanger(fx_specs=graph.fx_specs())
+>>> while True:
+>>>     ...
+>>>     values = graph.evaluate(tracks.snapshot(), dT)
+>>>     fx_changer.set_all(values)
+"""
+
+import json
+
+import numpy as np
+
+__all__ = ['ModGraph', 'FEATURES']
+
+FEATURES = ('coherence', 'density', 'activity', 'mean_speed',
+            'flow_x', 'flow_y', 'center_x', 'center_y')
+
+
+def _divide(a, b, default=0.0):
+    return np.divide(a, b, out=np.full_like(a, default, dtype=np.float64), where=b > 0)
+
+
+class ModGraph:
+    """The modulation graph compiled from a config (a dict, see above)."""
+
+    def __init__(self, config, width, height):
+        self.frame_size = np.array([width, height], np.float64)
+
+        regions = {'all': [0.0, 0.0, 1.0, 1.0]}
+        regions.update(config.get('regions', {}))
+        self.region_names = list(regions)
+        self.region_rects = np.array([regions[name] for name in self.region_names], np.float64)
+        if self.region_rects.shape[1:] != (4,):
+            raise ValueError("A region must be [x0, y0, x1, y1]")
+
+        outputs = config['outputs']
+        for n, output in enumerate(outputs):
+            if output['feature'] not in FEATURES:
+                raise ValueError("Unknown feature '%s' of the output #%d" % (output['feature'], n))
+            if output.get('region', 'all') not in regions:
+                raise ValueError("Unknown region '%s' of the output #%d" % (output['region'], n))
+
+        self.names = [output.get('name', str(n)) for n, output in enumerate(outputs)]
+        self.specs = [dict(channel_num=output['channel'],
+                           controller_num=output['controller'],
+                           default_val=output.get('default', 0.5),
+                           curve=output.get('curve', 'linear'))
+                      for output in outputs]
+
+        # The compiled graph: one array element per output.
+        self.feature_idx = np.array([FEATURES.index(o['feature']) for o in outputs], np.int64)
+        self.region_idx = np.array([self.region_names.index(o.get('region', 'all'))
+                                    for o in outputs], np.int64)
+        self.gain = np.array([o.get('gain', 1.0) for o in outputs], np.float64)
+        self.offset = np.array([o.get('offset', 0.0) for o in outputs], np.float64)
+        self.attack = np.array([o.get('attack', 0.0) for o in outputs], np.float64)
+        self.decay = np.array([o.get('decay', 0.0) for o in outputs], np.float64)
+        self.values = np.zeros(len(outputs), np.float64)
+
+    @staticmethod
+    def load(path, width, height):
+        with open(path) as f:
+            return ModGraph(json.load(f), width, height)
+
+    def __len__(self):
+        return len(self.values)
+
+    def fx_specs(self):
+        """MidiCcFx arguments for every output (see FxChanger)."""
+        return self.specs
+
+    def features(self, snap):
+        """Compute all FEATURES for every region: an array (regions, features)."""
+        # Tracks at the frame edges (or predicted off the frame) count as
+        # inside the edge regions.
+        positions = np.clip(snap.centers / self.frame_size, 0.0, 1.0 - 1e-9)
+        rects = self.region_rects
+        x = positions[:, 0]
+        y = positions[:, 1]
+        inside = ((x >= rects[:, 0, None]) & (x < rects[:, 2, None]) &
+                  (y >= rects[:, 1, None]) & (y < rects[:, 3, None]))
+        moving = (inside & snap.significant).astype(np.float64)
+        inside = inside.astype(np.float64)
+
+        # Sums over the tracks of every region are matrix products.
+        lengths = np.hypot(snap.velocities[:, 0], snap.velocities[:, 1])
+        count = inside.sum(axis=1)
+        n_moving = moving.sum(axis=1)
+        sum_velocity = moving @ snap.velocities
+        sum_length = moving @ lengths
+        sum_speed = moving @ snap.speeds
+        sum_position = inside @ positions
+
+        features = np.empty((len(rects), len(FEATURES)), np.float64)
+        features[:, 0] = _divide(np.hypot(sum_velocity[:, 0], sum_velocity[:, 1]), sum_length)
+        features[:, 1] = count
+        features[:, 2] = _divide(n_moving, count)
+        features[:, 3] = _divide(sum_speed, n_moving)
+        features[:, 4] = _divide(sum_velocity[:, 0], sum_length)
+        features[:, 5] = _divide(sum_velocity[:, 1], sum_length)
+        features[:, 6] = _divide(sum_position[:, 0], count, 0.5)
+        features[:, 7] = _divide(sum_position[:, 1], count, 0.5)
+        return features
+
+    def evaluate(self, snap, dT):
+        """Update all outputs with a tracks.TrackSnapshot, return their values."""
+        raw = self.features(snap)[self.region_idx, self.feature_idx]
+        target = np.clip(raw * self.gain + self.offset, 0.0, 1.0)
+
+        # The same exponential attack/decay as in the FxModulator.
+        time_constant = np.where(target > self.values, self.attack, self.decay)
+        k = np.exp(-dT / np.maximum(time_constant, 1e-9))
+        self.values = target + (self.values - target) * k
+        return self.values.copy()
+
+
+# =============================================================================
+#  test/demo
+# =============================================================================
+# When the file is executed, evaluate the example config (modgraph.json) and a
+# 32-output graph on random tracks, and measure the evaluation time.
+# The A, B, C outputs of the example config must match the FxModulator.
+
+if __name__ == '__main__':
+    import timeit
+
+    from detector import LightTable
+    from tracks import TrackStore
+    from fxmodulator import FxModulator
+
+    WIDTH, HEIGHT = 1920, 1080
+
+    def random_snapshot(n_lights):
+        rng = np.random.RandomState(0)
+        tracks = TrackStore(timestamp=1000.0)
+        positions = rng.uniform(0, [WIDTH, HEIGHT], (n_lights, 2))
+        for n in range(3):
+            positions += rng.normal(0, 30, (n_lights, 2)) + [20, 0]
+            matches = np.arange(n_lights) if n else np.full(n_lights, -1)
+            tracks.update(LightTable.from_centers(positions), matches, 1000.0 + n * 0.2)
+        return tracks.snapshot()
+
+    graph = ModGraph.load('modgraph.json', WIDTH, HEIGHT)
+    modulator = FxModulator()
+    snap = random_snapshot(100)
+    for n in range(10):
+        values = graph.evaluate(snap, 0.2)
+        assert np.allclose(values[:3], modulator.modulate_snapshot(snap, 0.2))
+    for name, value in zip(graph.names, values):
+        print("{:>12}: {:1.3f}".format(name, value))
+
+    # A grid of 4x4 regions, with two features per region.
+    regions = {}
+    outputs = []
+    for row in range(4):
+        for col in range(4):
+            name = 'r%d%d' % (row, col)
+            regions[name] = [col / 4, row / 4, (col + 1) / 4, (row + 1) / 4]
+            for feature in ('density', 'mean_speed'):
+                outputs.append({'feature': feature, 'region': name, 'gain': 0.01,
+                                'attack': 0.5, 'decay': 2.0,
+                                'channel': len(outputs) // 16, 'controller': len(outputs) % 16})
+    big_graph = ModGraph({'regions': regions, 'outputs': outputs}, WIDTH, HEIGHT)
+    for n_lights in (10, 100, 500):
+        snap = random_snapshot(n_lights)
+        t = min(timeit.repeat(lambda: big_graph.evaluate(snap, 0.03), number=100, repeat=3)) / 100
+        print("{} outputs, {} tracks: {:1.3f} ms".format(len(big_graph), n_lights, t * 1000))
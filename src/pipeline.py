@@ -0,0 +1,362 @@
+"""Stage-parallel version of the probe_opencv.py loop.
+
+The probe_opencv.py runs everything in one loop, on one core (because of GIL).
+Here the same work is split into separate processes:
+
+    capture --> detection (x DETECT_WORKERS) --> tracking/modulation --> preview
+
+The frames are passed through a FrameRing: a ring of frame slots in shared
+memory. Only small records are passed through the queues between processes:
+frame sequence numbers, light tables, track snapshots and A/B/C values.
+So there is no pickling/copying of frames at all.
+
+Each queue is bounded and the stages never block on a full queue: a record
+that doesn't fit is dropped (and counted), so a slow stage (e.g. the preview)
+can't stall the stages before it.
+
+Usage:
+$ python pipeline.py
+"""
+
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import queue
+import time
+
+import numpy as np
+import cv2
+
+from detector import preprocess, LightTable, ContourDetector, ComponentsDetector
+from hud import message, draw_lights, Plot, OverlayCompositor
+
+__all__ = ['FrameRing', 'run']
+
+CAMERA_ID = 0
+FRAME_WIDTH = 1920
+FRAME_HEIGHT = 1080
+
+DETECTOR_MODE = 'components'
+DETECT_WORKERS = max(1, mp.cpu_count() - 3)  # the rest is for other stages
+RING_SLOTS = 16
+QUEUE_SIZE = 4
+# The MIDI messages are sent at the frame capture time + MIDI_LATENCY ms
+# (see probe_opencv.py). The frames pass through several processes here,
+# so it is higher.
+MIDI_LATENCY = 60
+# The effect values are sent CONTROL_RATE times per second (see controlrate.py).
+# The modulation graph config (see modgraph.py), None - use the FxModulator.
+MODULATION_CONFIG = None
+CONTROL_RATE = 200
+
+
+class FrameRing:
+    """A ring of frames in shared memory.
+
+    The memory starts with a header: an array of sequence numbers, one per slot.
+    The frame number 'seq' is written to the slot 'seq % slots', and the
+    header says which frame is in each slot (-1 while the frame is written).
+    So readers can check that a slot was not overwritten while they were
+    reading it, without any locking (this is known as a "seqlock").
+    """
+
+    def __init__(self, shape, slots=RING_SLOTS, dtype=np.uint8, name=None):
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.dtype = np.dtype(dtype)
+
+        header_size = slots * np.dtype(np.int64).itemsize
+        frame_size = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner,
+                                              size=header_size + slots * frame_size)
+
+        self.seqs = np.ndarray((slots,), np.int64, self.shm.buf)
+        self.frames = np.ndarray((slots,) + self.shape, self.dtype, self.shm.buf, header_size)
+        if self.owner:
+            self.seqs[:] = -1
+        self.next_seq = 0
+
+    def spec(self):
+        """Arguments for attach() in another process."""
+        return self.shape, self.slots, self.dtype.str, self.shm.name
+
+    @staticmethod
+    def attach(shape, slots, dtype, name):
+        return FrameRing(shape, slots, dtype, name)
+
+    def write(self, frame):
+        seq = self.next_seq
+        slot = seq % self.slots
+        self.seqs[slot] = -1
+        self.frames[slot] = frame
+        self.seqs[slot] = seq
+        self.next_seq += 1
+        return seq
+
+    def is_valid(self, seq):
+        return self.seqs[seq % self.slots] == seq
+
+    def view(self, seq):
+        """Get the frame (without copying), or None if it is overwritten.
+
+        The data may still be overwritten while you use it, so check
+        is_valid() when you're done with it.
+        """
+        if not self.is_valid(seq):
+            return None
+        return self.frames[seq % self.slots]
+
+    def close(self):
+        # Views must be released before the shared memory is closed.
+        del self.seqs
+        del self.frames
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _put_or_drop(q, item, counter=None):
+    try:
+        q.put_nowait(item)
+    except queue.Full:
+        if counter is not None:
+            with counter.get_lock():
+                counter.value += 1
+
+
+def _get(q, stop):
+    """Wait for an item, return None if the pipeline is stopped."""
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+
+def open_camera():
+    cap = cv2.VideoCapture(CAMERA_ID)
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, FRAME_WIDTH)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, FRAME_HEIGHT)
+    return cap
+
+
+# =============================================================================
+#  stages
+# =============================================================================
+
+def capture_stage(ring_spec, detect_q, control_q, stop, dropped):
+    ring = FrameRing.attach(*ring_spec)
+    cap = open_camera()
+    try:
+        while not stop.is_set() and cap.isOpened():
+            # Control commands from the preview window (brightness changes).
+            try:
+                while True:
+                    prop_id, delta = control_q.get_nowait()
+                    cap.set(prop_id, cap.get(prop_id) + delta)
+            except queue.Empty:
+                pass
+
+            ok, frame = cap.read()
+            timestamp = time.time()
+            if not ok:
+                break
+            seq = ring.write(frame)
+            brightness = cap.get(cv2.CAP_PROP_BRIGHTNESS)
+            _put_or_drop(detect_q, (seq, timestamp, brightness), dropped)
+    finally:
+        stop.set()
+        cap.release()
+        ring.close()
+
+
+def detect_stage(ring_spec, detect_q, track_q, stop, dropped):
+    ring = FrameRing.attach(*ring_spec)
+    if DETECTOR_MODE == 'contours':
+        detector = ContourDetector()
+    else:
+        detector = ComponentsDetector()
+    try:
+        while True:
+            item = _get(detect_q, stop)
+            if item is None:
+                break
+            seq, timestamp, brightness = item
+            frame = ring.view(seq)
+            if frame is None:
+                continue
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            del frame
+            if not ring.is_valid(seq):
+                continue  # the frame was overwritten while we were reading it
+            table = detector.detect(preprocess(gray))
+            _put_or_drop(track_q, (seq, timestamp, brightness, table), dropped)
+    finally:
+        ring.close()
+
+
+def track_stage(track_q, preview_q, stop, distance_coefficient, dropped):
+    # Import here, so only this process needs the MIDI output.
+    from tracker import NearestTracker
+    from tracks import TrackStore
+    from fxmodulator import FxModulator
+    from fxchanger import FxChanger
+    from controlrate import ControlRateEngine
+    from modgraph import ModGraph
+
+    tracker = NearestTracker()
+    tracks = TrackStore()
+    modulator = FxModulator()
+    graph = None
+    fx_specs = None
+    if MODULATION_CONFIG:
+        graph = ModGraph.load(MODULATION_CONFIG, FRAME_WIDTH, FRAME_HEIGHT)
+        fx_specs = graph.fx_specs()
+    fx_changer = FxChanger(latency=MIDI_LATENCY, fx_specs=fx_specs)
+    engine = ControlRateEngine(fx_changer, CONTROL_RATE)
+    engine.start()
+    prev_table = LightTable.empty()
+    prev_timestamp = time.time()
+
+    try:
+        while True:
+            item = _get(track_q, stop)
+            if item is None:
+                break
+            seq, timestamp, brightness, table = item
+            # Detection workers may finish frames out of order.
+            # A frame that is older than the last tracked one is useless.
+            if timestamp <= prev_timestamp:
+                continue
+            dT = timestamp - prev_timestamp
+            prev_timestamp = timestamp
+
+            matches = tracker.match(prev_table.centers, prev_table.radii,
+                                    table.centers, table.radii, distance_coefficient.value)
+            tracks.update(table, matches, timestamp)
+            prev_table = table
+
+            snap = tracks.snapshot()
+            if graph is not None:
+                values = graph.evaluate(snap, dT)
+            else:
+                values = modulator.modulate_snapshot(snap, dT)
+            engine.submit(values, timestamp)
+            # The preview plot shows only the first three values.
+            A, B, C = (tuple(values[:3]) + (0.0, 0.0, 0.0))[:3]
+
+            _put_or_drop(preview_q, (seq, dT, brightness, snap, (A, B, C)), dropped)
+    finally:
+        engine.stop()
+        fx_changer.flush()
+        fx_changer.close()
+
+
+def preview_stage(ring_spec, preview_q, control_q, stop, distance_coefficient, dropped):
+    ring = FrameRing.attach(*ring_spec)
+    height, width = ring.shape[:2]
+    pl = Plot(0, height - 120, width, 120)
+    compositor = OverlayCompositor()
+    for rgba, x, y in pl.static_layers():
+        compositor.add_layer(rgba, x, y)
+    logo = cv2.imread('logo.png', -1)
+    if logo is not None:
+        compositor.add_layer(logo, width - 125, 10)
+    try:
+        while True:
+            item = _get(preview_q, stop)
+            if item is None:
+                break
+            seq, dT, brightness, snap, (A, B, C) = item
+            frame = ring.view(seq)
+            if frame is None:
+                continue
+            frame = frame.copy()
+            if not ring.is_valid(seq):
+                continue
+
+            draw_lights(frame, snap)
+            message(
+                "Frame size: {} x {}. Fps: {:1.1f}. Brightness: {}. DistanceC: {}"
+                    .format(width, height, 1.0 / dT, brightness, distance_coefficient.value), (10, 20), frame)
+            message("Numbers of lights: {}".format(len(snap)), (10, 35), frame)
+            message("Frame dT, ms: {}".format(dT * 1000), (10, 50), frame)
+            message("Dropped records: {}".format(dropped.value), (10, 65), frame)
+            pl.draw_values(frame, A, B, C)
+            compositor.compose(frame)
+            cv2.imshow('Captured', frame)
+
+            key = cv2.waitKey(1)
+            if key & 0xFF == ord('q'):
+                stop.set()
+
+            if key & 0xFF == ord('b'):
+                control_q.put((cv2.CAP_PROP_BRIGHTNESS, +1.0))
+
+            if key & 0xFF == ord('v'):
+                control_q.put((cv2.CAP_PROP_BRIGHTNESS, -1.0))
+
+            if key & 0xFF == ord('m'):
+                with distance_coefficient.get_lock():
+                    distance_coefficient.value += 5
+
+            if key & 0xFF == ord('n'):
+                with distance_coefficient.get_lock():
+                    distance_coefficient.value -= 5
+    finally:
+        cv2.destroyAllWindows()
+        ring.close()
+
+
+# =============================================================================
+#  entry point
+# =============================================================================
+
+def run():
+    # Read one frame to find out the actual frame size.
+    cap = open_camera()
+    ok, frame = cap.read()
+    cap.release()
+    if not ok:
+        raise RuntimeError("Can't read a frame from camera #%d" % CAMERA_ID)
+
+    ring = FrameRing(frame.shape, RING_SLOTS, frame.dtype)
+    spec = ring.spec()
+
+    stop = mp.Event()
+    distance_coefficient = mp.Value('i', 30)
+    dropped = mp.Value('i', 0)
+    control_q = mp.Queue()
+    detect_q = mp.Queue(DETECT_WORKERS)
+    track_q = mp.Queue(QUEUE_SIZE)
+    preview_q = mp.Queue(QUEUE_SIZE)
+
+    processes = [
+        mp.Process(target=capture_stage, name='capture',
+                   args=(spec, detect_q, control_q, stop, dropped)),
+        mp.Process(target=track_stage, name='track',
+                   args=(track_q, preview_q, stop, distance_coefficient, dropped)),
+        mp.Process(target=preview_stage, name='preview',
+                   args=(spec, preview_q, control_q, stop, distance_coefficient, dropped)),
+    ]
+    for n in range(DETECT_WORKERS):
+        processes.append(mp.Process(target=detect_stage, name='detect-%d' % n,
+                                    args=(spec, detect_q, track_q, stop, dropped)))
+
+    for p in processes:
+        p.start()
+    try:
+        while not stop.is_set():
+            stop.wait(0.5)
+    finally:
+        stop.set()
+        for p in processes:
+            p.join(timeout=2.0)
+            if p.is_alive():
+                p.terminate()
+        ring.close()
+
+
+if __name__ == '__main__':
+    run()
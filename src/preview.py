@@ -0,0 +1,128 @@
+"""The preview window, rendered on its own thread at its own rate.
+
+Drawing the preview (and especially cv2.imshow()/cv2.waitKey()) takes a lot of
+time, and we don't need it at the camera frame rate. So the processing loop
+only submit()s a PreviewSnapshot of its state (a reference swap, no drawing),
+and the PreviewRenderer thread draws the newest snapshot at the preview rate.
+So the preview never adds latency to the MIDI output.
+
+All the OpenCV GUI calls are made on the renderer thread, and the pressed keys
+are passed back to the processing loop (see poll_keys()).
+"""
+
+import collections
+import threading
+import time
+
+import cv2
+
+from hud import message, draw_lights, Plot, OverlayCompositor
+
+__all__ = ['PreviewSnapshot', 'PreviewRenderer']
+
+PREVIEW_FPS = 10
+
+
+class PreviewSnapshot:
+    """Everything the preview needs to draw a frame.
+
+    frame      - the captured frame (not drawn on by anyone else)
+    to_bgr     - a function that converts the frame to a color image
+    tracks     - a tracks.TrackSnapshot
+    values     - the (A, B, C) effect values
+    thresh_img - the last thresholded image (or None)
+    lines      - text lines to print over the frame
+    """
+
+    def __init__(self, frame, to_bgr, tracks, values, thresh_img, lines):
+        self.frame = frame
+        self.to_bgr = to_bgr
+        self.tracks = tracks
+        self.values = values
+        self.thresh_img = thresh_img
+        self.lines = lines
+
+
+class PreviewRenderer:
+
+    def __init__(self, fps=PREVIEW_FPS, logo_path='logo.png'):
+        self.fps = fps
+        self.logo = cv2.imread(logo_path, -1)
+        self.rendered = 0
+
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._keys = collections.deque()
+        self._running = False
+        self._thread = None
+        self._plot = None
+        self._compositor = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='PreviewRenderer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, snapshot):
+        """Replace the snapshot to be drawn next (older ones are skipped)."""
+        with self._lock:
+            self._snapshot = snapshot
+
+    def poll_keys(self):
+        """Get the keys pressed in the preview window since the last call."""
+        keys = []
+        while self._keys:
+            keys.append(self._keys.popleft())
+        return keys
+
+    def _run(self):
+        next_time = time.time()
+        while self._running:
+            with self._lock:
+                snapshot, self._snapshot = self._snapshot, None
+            if snapshot is not None:
+                self.render(snapshot)
+
+            # cv2.waitKey() also runs the GUI event loop, so call it even if
+            # there is nothing new to draw.
+            key = cv2.waitKey(1)
+            if key != -1:
+                self._keys.append(key & 0xFF)
+
+            next_time += 1.0 / self.fps
+            delay = next_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_time = time.time()  # too slow, don't try to catch up
+
+        cv2.destroyAllWindows()
+
+    def render(self, snapshot):
+        frame = snapshot.to_bgr(snapshot.frame)
+        height, width = frame.shape[:2]
+        if self._plot is None:
+            self._plot = Plot(0, height - 120, width, 120)
+            self._compositor = OverlayCompositor()
+            for rgba, x, y in self._plot.static_layers():
+                self._compositor.add_layer(rgba, x, y)
+            if self.logo is not None:
+                self._compositor.add_layer(self.logo, width - 125, 10)
+
+        draw_lights(frame, snapshot.tracks)
+        for n, line in enumerate(snapshot.lines):
+            message(line, (10, 20 + n * 15), frame)
+        self._plot.draw_values(frame, *snapshot.values)
+        self._compositor.compose(frame)
+
+        if snapshot.thresh_img is not None:
+            cv2.imshow('Threshold', snapshot.thresh_img)
+        cv2.imshow('Captured', frame)
+        self.rendered += 1
@@ -0,0 +1,133 @@
+"""Matching of lights between two consecutive frames.
+
+The NearestTracker() works on arrays of centers/radii (see detector.LightTable)
+instead of comparing every light with every previous light in Python.
+
+The previous centers are hashed into a uniform grid with the cell size equal
+to the largest possible acceptance distance. So all candidates for a light are
+in the 3x3 neighbourhood of its cell, and the candidate pairs are produced
+with a few NumPy sort/search calls, no matter how many lights are there.
+
+A light is matched to its nearest previous light if the distance between them
+is less than:
+    (prev_radius + radius) / 2 + distance_coefficient
+Several lights may be matched to the same previous light (that is what the
+original loop did). With optimal=True, a globally optimal one-to-one
+assignment is made instead (requires scipy).
+"""
+
+import numpy as np
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+__all__ = ['NearestTracker']
+
+NO_MATCH = -1
+
+# Grid cell coordinates are packed into a single int64 key.
+_KEY_STRIDE = 1 << 24
+_KEY_OFFSET = 1 << 22
+
+
+def _cell_keys(cells, dx=0, dy=0):
+    return (cells[:, 0] + (dx + _KEY_OFFSET)) * _KEY_STRIDE + (cells[:, 1] + (dy + _KEY_OFFSET))
+
+
+def candidate_pairs(prev_centers, centers, cell_size):
+    """Find all (light, prev) index pairs that are in neighbouring grid cells.
+
+    Every pair closer than the cell_size is guaranteed to be in the result.
+    Returns two int arrays of the same length: curr_idx, prev_idx.
+    """
+    prev_cells = np.floor(prev_centers / cell_size).astype(np.int64)
+    cells = np.floor(centers / cell_size).astype(np.int64)
+
+    prev_keys = _cell_keys(prev_cells)
+    order = np.argsort(prev_keys, kind='stable')
+    sorted_keys = prev_keys[order]
+
+    all_curr = []
+    all_prev = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            keys = _cell_keys(cells, dx, dy)
+            lo = np.searchsorted(sorted_keys, keys, 'left')
+            hi = np.searchsorted(sorted_keys, keys, 'right')
+            counts = hi - lo
+            total = counts.sum()
+            if total == 0:
+                continue
+            # Expand each [lo, hi) range into individual indices.
+            group_starts = np.cumsum(counts) - counts
+            offsets = np.arange(total) - np.repeat(group_starts, counts)
+            all_curr.append(np.repeat(np.arange(len(centers)), counts))
+            all_prev.append(order[np.repeat(lo, counts) + offsets])
+
+    if not all_curr:
+        empty = np.zeros(0, np.int64)
+        return empty, empty
+    return np.concatenate(all_curr), np.concatenate(all_prev)
+
+
+class NearestTracker:
+
+    def __init__(self, optimal=False):
+        if optimal and linear_sum_assignment is None:
+            raise ImportError("NearestTracker(optimal=True) requires scipy")
+        self.optimal = optimal
+
+    def match(self, prev_centers, prev_radii, centers, radii, distance_coefficient):
+        """Match current lights to the previous ones.
+
+        Returns an int array of shape (N,) with the index of the matched
+        previous light for every current light (or NO_MATCH).
+        """
+        matches = np.full(len(centers), NO_MATCH, np.int64)
+        if len(centers) == 0 or len(prev_centers) == 0:
+            return matches
+
+        max_gate = (prev_radii.max() + radii.max()) / 2 + distance_coefficient
+        if max_gate <= 0:
+            return matches
+        ci, pi = candidate_pairs(prev_centers, centers, max_gate)
+        if len(ci) == 0:
+            return matches
+
+        d = np.hypot(*(centers[ci] - prev_centers[pi]).T)
+        gate = (prev_radii[pi] + radii[ci]) / 2 + distance_coefficient
+
+        if self.optimal:
+            self._assign_optimal(ci, pi, d, gate, matches)
+        else:
+            self._assign_nearest(ci, pi, d, gate, matches)
+        return matches
+
+    @staticmethod
+    def _assign_nearest(ci, pi, d, gate, matches):
+        # Sort pairs by light, then by distance (ties go to the lower prev
+        # index), and take the first (nearest) pair of each light.
+        order = np.lexsort((pi, d, ci))
+        ci, pi, d, gate = ci[order], pi[order], d[order], gate[order]
+        is_first = np.ones(len(ci), bool)
+        is_first[1:] = ci[1:] != ci[:-1]
+        accepted = is_first & (d < gate)
+        matches[ci[accepted]] = pi[accepted]
+
+    @staticmethod
+    def _assign_optimal(ci, pi, d, gate, matches):
+        ok = d < gate
+        ci, pi, d = ci[ok], pi[ok], d[ok]
+        if len(ci) == 0:
+            return
+        rows, row_idx = np.unique(ci, return_inverse=True)
+        cols, col_idx = np.unique(pi, return_inverse=True)
+        # Pairs that didn't pass the gate get a cost that is never worth it.
+        forbidden = d.max() * (len(rows) + len(cols)) + 1.0
+        cost = np.full((len(rows), len(cols)), forbidden)
+        cost[row_idx, col_idx] = d
+        r, c = linear_sum_assignment(cost)
+        ok = cost[r, c] < forbidden
+        matches[rows[r[ok]]] = cols[c[ok]]
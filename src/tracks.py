@@ -0,0 +1,304 @@
+"""Storage of tracked lights.
+
+A track is a light that is followed from frame to frame. Each track has a
+persistent ID and a short history of its recent positions and timestamps,
+kept in a fixed-size ring buffer. Contours and older positions are not kept,
+so the memory usage depends only on the number of lights in the frame,
+not on how long the show runs.
+
+All tracks live in preallocated arrays of the TrackStore() (one row per
+track "slot"), and the Light objects are just lightweight views of these rows.
+"""
+
+import math
+import time
+
+import numpy as np
+
+from detector import LightTable
+from tracker import NO_MATCH
+
+__all__ = ['TrackStore', 'TrackSnapshot', 'Light', 'Point', 'Vector2']
+
+SPEED_THRESHOLD = 100  # pixels per second
+MATURITY_TIME = 0.2  # seconds
+HISTORY_SIZE = 8
+
+
+def calc_distance(p1, p2):
+    dX = p1.x - p2.x
+    dY = p1.y - p2.y
+    return math.sqrt(dX * dX + dY * dY)
+
+
+class Point:
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+class Vector2:
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+    def len(self):
+        return calc_distance(self.start, self.end)
+
+
+class TrackSnapshot:
+    """A copy of the active tracks state (last two positions of each track).
+
+    It is a small record of plain arrays, so it is cheap to pass to another
+    thread or process (e.g. to the preview renderer).
+    """
+
+    def __init__(self, timestamp, ids, centers, prev_centers, dts, bboxes, colors, born):
+        self.timestamp = timestamp
+        self.ids = ids
+        self.centers = centers
+        self.prev_centers = prev_centers
+        self.dts = dts
+        self.bboxes = bboxes
+        self.colors = colors
+        self.born = born
+
+        self.velocities = centers - prev_centers
+        lengths = np.hypot(self.velocities[:, 0], self.velocities[:, 1])
+        self.speeds = np.divide(lengths, dts, out=np.zeros_like(lengths), where=dts > 0)
+        self.ages = timestamp - born
+        self.significant = (self.speeds > SPEED_THRESHOLD) & (self.ages > MATURITY_TIME)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class TrackStore:
+    """Tracks stored in arrays. The arrays grow (by doubling) only when there
+    are more lights in a single frame than the current capacity.
+
+    After each update(), the 'active' array contains slots of the tracks that
+    are visible in the current frame, in the order of the LightTable rows.
+    """
+
+    def __init__(self, capacity=256, history_size=HISTORY_SIZE, timestamp=None):
+        self.history_size = history_size
+        self.capacity = 0
+        self.next_id = 0
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.active = np.zeros(0, np.int64)
+        self.free = np.zeros(0, np.int64)
+        self._grow(capacity)
+
+    def _grow(self, capacity):
+        old = self.capacity
+        h = self.history_size
+
+        def grown(array, shape, dtype):
+            new_array = np.zeros((capacity,) + shape, dtype)
+            if old:
+                new_array[:old] = array
+            return new_array
+
+        self.ids = grown(getattr(self, 'ids', None), (), np.int64)
+        self.positions = grown(getattr(self, 'positions', None), (h, 2), np.float32)
+        self.times = grown(getattr(self, 'times', None), (h,), np.float64)
+        self.head = grown(getattr(self, 'head', None), (), np.int64)
+        self.count = grown(getattr(self, 'count', None), (), np.int64)
+        self.born = grown(getattr(self, 'born', None), (), np.float64)
+        self.colors = grown(getattr(self, 'colors', None), (3,), np.int64)
+        self.radii = grown(getattr(self, 'radii', None), (), np.float32)
+        self.areas = grown(getattr(self, 'areas', None), (), np.float32)
+        self.bboxes = grown(getattr(self, 'bboxes', None), (4,), np.int32)
+
+        # Free slots are popped from the end, so keep lower slots at the end.
+        self.free = np.concatenate((np.arange(capacity - 1, old - 1, -1), self.free))
+        self.capacity = capacity
+
+    def _alloc(self, n):
+        if n > len(self.free):
+            capacity = self.capacity
+            while capacity - self.capacity + len(self.free) < n:
+                capacity *= 2
+            self._grow(capacity)
+        slots = self.free[len(self.free) - n:]
+        self.free = self.free[:len(self.free) - n]
+        return slots
+
+    def update(self, table, matches, timestamp):
+        """Add a frame of detected lights.
+
+        @table is a detector.LightTable, @matches is the tracker.match() result:
+        indices of the previous frame lights (i.e. of the previous 'active'
+        slots) matched to every light in the table.
+        """
+        prev_active = self.active
+        n = len(table)
+        slots = np.zeros(n, np.int64)
+
+        matched = np.flatnonzero(matches != NO_MATCH)
+        parents = prev_active[matches[matched]]
+        # The first light matched to a track continues it. If several lights
+        # are matched to the same track, the others fork it: they get a new
+        # ID, but inherit the history, color and birth time.
+        # (np.unique() sorts the parents, so 'first' is in the parents order.)
+        continued_parents, first = np.unique(parents, return_index=True)
+        is_fork = np.ones(len(matched), bool)
+        is_fork[first] = False
+        slots[matched[first]] = continued_parents
+
+        # Tracks that are not continued are lost, their slots are reused.
+        lost = np.setdiff1d(prev_active, continued_parents, assume_unique=True)
+        self.free = np.concatenate((self.free, lost[::-1]))
+
+        forks = matched[is_fork]
+        fork_parents = parents[is_fork]
+        fork_slots = self._alloc(len(forks))
+        slots[forks] = fork_slots
+        for array in (self.positions, self.times, self.head, self.count,
+                      self.born, self.colors):
+            array[fork_slots] = array[fork_parents]
+
+        fresh = np.flatnonzero(matches == NO_MATCH)
+        fresh_slots = self._alloc(len(fresh))
+        slots[fresh] = fresh_slots
+        self.head[fresh_slots] = -1
+        self.count[fresh_slots] = 0
+        self.born[fresh_slots] = timestamp
+        self.colors[fresh_slots] = np.random.randint(0, 255, (len(fresh), 3))
+
+        new_slots = np.concatenate((fork_slots, fresh_slots))
+        self.ids[new_slots] = self.next_id + np.arange(len(new_slots))
+        self.next_id += len(new_slots)
+
+        # Push the new positions into the ring buffers.
+        head = (self.head[slots] + 1) % self.history_size
+        self.head[slots] = head
+        self.positions[slots, head] = table.centers
+        self.times[slots, head] = timestamp
+        self.count[slots] = np.minimum(self.count[slots] + 1, self.history_size)
+        self.radii[slots] = table.radii
+        self.areas[slots] = table.areas
+        self.bboxes[slots] = table.bboxes
+
+        self.active = slots
+        self.timestamp = timestamp
+
+    def predict(self, timestamp):
+        """Move the active tracks without a detection (e.g. on skipped frames).
+
+        Each track is moved with its last velocity, and the predicted position
+        is pushed into its history as if it was detected.
+        """
+        slots = self.active
+        head = self.head[slots]
+        prev = (head - 1) % self.history_size
+        has_prev = self.count[slots] > 1
+
+        last_dt = self.times[slots, head] - self.times[slots, prev]
+        moving = has_prev & (last_dt > 0)
+        velocity = np.zeros((len(slots), 2))
+        velocity[moving] = ((self.positions[slots, head] - self.positions[slots, prev])[moving] /
+                            last_dt[moving, None])
+        shift = velocity * (timestamp - self.times[slots, head])[:, None]
+
+        new_head = (head + 1) % self.history_size
+        self.head[slots] = new_head
+        self.positions[slots, new_head] = self.positions[slots, head] + shift
+        self.times[slots, new_head] = timestamp
+        self.count[slots] = np.minimum(self.count[slots] + 1, self.history_size)
+        self.bboxes[slots, :2] += np.round(shift).astype(np.int32)
+        self.timestamp = timestamp
+
+    def table(self):
+        """The current positions of the active tracks as a LightTable."""
+        slots = self.active
+        return LightTable(self.positions[slots, self.head[slots]],
+                          self.radii[slots], self.areas[slots], self.bboxes[slots])
+
+    def snapshot(self):
+        slots = self.active
+        head = self.head[slots]
+        prev = (head - 1) % self.history_size
+        has_prev = self.count[slots] > 1
+
+        centers = self.positions[slots, head].astype(np.float64)
+        prev_centers = np.where(has_prev[:, None], self.positions[slots, prev], centers)
+        dts = np.where(has_prev, self.times[slots, head] - self.times[slots, prev], 0.0)
+        return TrackSnapshot(self.timestamp, self.ids[slots], centers, prev_centers, dts,
+                             self.bboxes[slots], self.colors[slots], self.born[slots])
+
+    def lights(self):
+        """Light views of the active tracks (in the order of the last table)."""
+        return [Light(self, slot) for slot in self.active]
+
+
+class Light:
+    """A view of a single track in the TrackStore."""
+
+    MATURITY_TIME = MATURITY_TIME
+
+    def __init__(self, store, slot):
+        self.store = store
+        self.slot = slot
+
+    def _point(self, age=0):
+        """The position @age frames ago (0 is the current one)."""
+        s = self.store
+        idx = (s.head[self.slot] - age) % s.history_size
+        x, y = s.positions[self.slot, idx]
+        return Point(float(x), float(y))
+
+    @property
+    def track_id(self):
+        return int(self.store.ids[self.slot])
+
+    @property
+    def center(self):
+        return self._point()
+
+    @property
+    def radius(self):
+        return float(self.store.radii[self.slot])
+
+    @property
+    def bbox(self):
+        return tuple(int(v) for v in self.store.bboxes[self.slot])
+
+    @property
+    def color(self):
+        return tuple(int(v) for v in self.store.colors[self.slot])
+
+    @property
+    def born(self):
+        return float(self.store.born[self.slot])
+
+    @property
+    def dT(self):
+        s = self.store
+        if s.count[self.slot] < 2:
+            return 0
+        head = s.head[self.slot]
+        prev = (head - 1) % s.history_size
+        return float(s.times[self.slot, head] - s.times[self.slot, prev])
+
+    def has_previous(self):
+        return self.store.count[self.slot] > 1
+
+    def vec(self):
+        if not self.has_previous():
+            return Vector2(self.center, self.center)
+        else:
+            return Vector2(self._point(1), self.center)
+
+    def speed(self):
+        dT = self.dT
+        if dT == 0:
+            return 0
+        else:
+            return self.vec().len() / dT
+
+    def is_significant(self, now=None):
+        if now is None:
+            now = self.store.timestamp
+        return self.speed() > SPEED_THRESHOLD and ((now - self.born) > self.MATURITY_TIME)
@@ -20,6 +20,8 @@ THE SOFTWARE.
 
 import math
 
+import numpy as np
+
 class Vector(object):
     def __init__(self, *args):
         """ Create a vector, example: v = Vector(1,2) """
@@ -133,4 +135,163 @@ class Vector(object):
         return self.values[key]
         
     def __repr__(self):
-        return str(self.values)
\ No newline at end of file
+        return str(self.values)
+
+
+class VectorArray(object):
+    """ N vectors of the same dimension, kept in one contiguous (N, dim) float64
+        array. It has the operations of Vector, computed for all vectors at once.
+
+        Example:
+        va = VectorArray([(1, 0), (0, 2)])
+        va.norm() -> array([1., 2.])
+        va.rotate(90).values -> array([[0., 1.], [-2., 0.]]) (up to rounding)
+    """
+
+    def __init__(self, values, dim=2):
+        """ Create from an (N, dim) array or a list of N tuples/Vectors.
+            The @dim is used only when the list is empty.
+        """
+        values = np.ascontiguousarray(values, dtype=np.float64)
+        if values.size == 0:
+            values = values.reshape(0, dim)
+        if values.ndim != 2:
+            raise ValueError("VectorArray values must be an (N, dim) array")
+        self.values = values
+
+    @staticmethod
+    def from_vectors(vectors, dim=2):
+        """ Create from a list of Vector objects """
+        return VectorArray([v.values for v in vectors], dim)
+
+    def to_vectors(self):
+        """ Returns a list of Vector objects """
+        return [Vector(*row) for row in self.values.tolist()]
+
+    @property
+    def dim(self):
+        return self.values.shape[1]
+
+    def norm(self):
+        """ Returns an (N,) array of norms """
+        return np.sqrt(np.einsum('ij,ij->i', self.values, self.values))
+
+    def argument(self):
+        """ Returns an (N,) array of arguments, the angles clockwise from +y
+            in degrees (0 for zero vectors).
+        """
+        if self.dim != 2:
+            raise ValueError("Argument is defined only for 2D vectors")
+        return np.degrees(np.arctan2(self.values[:, 0], self.values[:, 1])) % 360
+
+    def normalize(self):
+        """ Returns unit vectors (zero vectors stay zero) """
+        norm = self.norm()[:, None]
+        return VectorArray(np.divide(self.values, norm,
+                                     out=np.zeros_like(self.values), where=norm > 0))
+
+    def rotate(self, arg):
+        """ Rotate the vectors. If passed a number (or an (N,) array of numbers),
+            assumes these are 2D vectors and rotates them by the value in
+            degrees. Otherwise, assumes the passed value is a matrix.
+        """
+        if np.ndim(arg) <= 1:
+            if self.dim != 2:
+                raise ValueError("Rotation axis not defined for greater than 2D vector")
+            theta = np.radians(arg)
+            dc, ds = np.cos(theta), np.sin(theta)
+            x, y = self.values[:, 0], self.values[:, 1]
+            return VectorArray(np.stack((dc*x - ds*y, ds*x + dc*y), axis=1))
+        matrix = np.asarray(arg, dtype=np.float64)
+        if matrix.shape != (self.dim, self.dim):
+            raise ValueError("Rotation matrix must be square and same dimensions as vector")
+        return self.matrix_mult(matrix)
+
+    def matrix_mult(self, matrix):
+        """ Multiply every vector by a matrix (see Vector.matrix_mult()) """
+        matrix = np.asarray(matrix, dtype=np.float64)
+        if matrix.ndim != 2 or matrix.shape[1] != self.dim:
+            raise ValueError('Matrix must match vector dimensions')
+        return VectorArray(self.values @ matrix.T)
+
+    def dot(self, other):
+        """ Returns an (N,) array of dot products with other VectorArray
+            (pairwise), or with a single Vector (or tuple).
+        """
+        other = _values(other)
+        if other.ndim == 1:
+            return self.values @ other
+        return np.einsum('ij,ij->i', self.values, other)
+
+    def sum(self):
+        """ Returns the sum of all vectors (a Vector) """
+        return Vector(*self.values.sum(axis=0).tolist())
+
+    def __add__(self, other):
+        """ Adds a VectorArray (pairwise) or a single Vector to every vector """
+        return VectorArray(self.values + _values(other))
+
+    def __sub__(self, other):
+        return VectorArray(self.values - _values(other))
+
+    def __mul__(self, other):
+        """ Multiplies each vector by a number (or by an (N,) array of numbers) """
+        other = np.asarray(other, dtype=np.float64)
+        return VectorArray(self.values * (other[:, None] if other.ndim == 1 else other))
+
+    __rmul__ = __mul__
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, key):
+        """ An int gives a Vector, a slice or a mask gives a VectorArray """
+        if isinstance(key, (int, np.integer)):
+            return Vector(*self.values[key].tolist())
+        return VectorArray(self.values[key], self.dim)
+
+    def __repr__(self):
+        return 'VectorArray(%s)' % self.values.tolist()
+
+
+def _values(other):
+    """ The values of a Vector/VectorArray (or a tuple/array) as a float array """
+    if isinstance(other, (Vector, VectorArray)):
+        other = other.values
+    return np.asarray(other, dtype=np.float64)
+
+
+# =============================================================================
+#  test/demo
+# =============================================================================
+# When the file is executed, check that VectorArray gives the same results as
+# Vector, and compare their speed on the operations done for every light.
+
+if __name__ == '__main__':
+    import timeit
+
+    rng = np.random.RandomState(0)
+    for n_vectors in (10, 100, 1000):
+        points = rng.normal(0, 10, (n_vectors, 2))
+        vectors = [Vector(*p) for p in points.tolist()]
+        va = VectorArray(points)
+        assert np.allclose(va.norm(), [v.norm() for v in vectors])
+        assert np.allclose(va.argument(), [v.argument() for v in vectors])
+        assert np.allclose(va.rotate(30).values, [v.rotate(30.).values for v in vectors])
+
+        def scalar():
+            moved = [v - Vector(1, 1) for v in vectors]
+            return [v.normalize().rotate(30.) for v in moved], [v.norm() for v in moved]
+
+        def batch():
+            moved = va - Vector(1, 1)
+            return moved.normalize().rotate(30), moved.norm()
+
+        def convert():
+            return VectorArray.from_vectors(vectors).to_vectors()
+
+        t_scalar, t_batch, t_convert = (
+            min(timeit.repeat(fn, number=20, repeat=3)) / 20 for fn in (scalar, batch, convert))
+        print("{:>5} vectors: Vector {:8.3f} ms, VectorArray {:6.3f} ms ({:4.0f}x), "
+              "conversion both ways {:6.3f} ms".format(
+                  n_vectors, t_scalar * 1000, t_batch * 1000, t_scalar / t_batch, t_convert * 1000))